@@ -9,12 +9,25 @@ bl_info = {
 }
 
 import bpy
-import colorsys
-import random
+import time
+import gp_maps as maps
+import gp_utils as gp
+import gp_farm
+import gp_cache
+import gp_incremental
+import gp_pack
+import gp_atlas
+import gp_profile
+import gp_memory
+import gp_bakemat
+import gp_projection
+from collections import OrderedDict
+from bpy.app.handlers import persistent
 from bpy.props import (
         StringProperty,
         BoolProperty,
         FloatProperty,
+        FloatVectorProperty,
         IntProperty,
         EnumProperty,
         CollectionProperty,
@@ -22,46 +35,37 @@ from bpy.props import (
 
 DRAWLIST = []
 
-def min_vertex(mesh, axis):
-    """Finds the minimum positioned vertex in mesh given axis"""
-    for i, vt in enumerate(mesh.vertices):
-        v = eval('.'.join(['vt.co', axis]))
-        if i == 0:
-            min = v
-        if v < min:
-            min = v
-    return min
-
-def enable_color_bake_settings():
-    scn = bpy.context.scene
-    bake_settings = bpy.data.scenes[scn.name].render.bake
-    bake_settings.use_pass_color = True
-    bake_settings.use_pass_direct = False
-    bake_settings.use_pass_indirect = False
-
-def smart_uv_project():
-    """Pre-defined settings for existing uv projection OT"""
-    bpy.ops.uv.smart_project(
-        angle_limit=66,
-        island_margin=0.02,
-        user_area_weight=0,
-        use_aspect=False,
-        stretch_to_bounds=True
-        )
+MAP_ITEMS = [('AO', 'Ambient Occlusion', ''),
+             ('CURVE', 'Curvature', ''),
+             ('POS', 'Position', ''),
+             ('ID', 'ID', '')]
+MAP_TYPES = [item[0] for item in MAP_ITEMS]
 
 def handle_projection(context):
     """Creates a UV map if none exists"""
-    if len(context.object.data.uv_textures) == 0:
-        uv_map = context.object.data.uv_textures.new()
-        smart_uv_project()
+    gp_projection.project(context, [context.object], context.scene.projection_mode)
+
+def handle_projections(context, objects):
+    """Creates a UV map on every object without one. Each is projected on its own, not packed together"""
+    gp_projection.project(context, objects, context.scene.projection_mode)
 
-def get_img(ob, name, width, height):
+def get_img(ob, name, width, height, map_type):
     """Returns an image type"""
     img = bpy.data.images.new(name, width, height)
     img.use_fake_user = True
+    img[gp_memory.OWNER] = gp_memory.owner_key(ob)
+    img[gp_memory.MAP] = map_type
+    gp.register_item('BAKE', img)
     return img
 
-def check_img(ob, map_type):
+def finish_images(context, images):
+    """Queues freshly baked images for packing and keeps add-on images within the memory budget"""
+    for image in images:
+        gp_pack.defer(image)
+        gp_memory.touch(image)
+    gp_memory.enforce(context.scene)
+
+def check_img(ob, map_type, use_active=True):
     """Checks if an Image node is selected with an active image. Returns image if true"""
     try:
         nodes = ob.active_material.node_tree.nodes
@@ -70,6 +74,8 @@ def check_img(ob, map_type):
                 return node.image
     except:
         pass
+    if not use_active:
+        return None
     try:
         nodes = ob.active_material.node_tree.nodes
         nodes.active.label = map_type
@@ -77,150 +83,238 @@ def check_img(ob, map_type):
     except:
         return None
 
-def create_bake_mat(context, name):
-    """Returns a material and the output node of that material"""
-    ob = context.active_object
-    mat = bpy.data.materials.new(name)
-    mat.use_nodes = True
-    out_node = mat.node_tree.nodes['Diffuse BSDF']
-    out_node.name = 'out'
-
-    return mat, out_node
-
-def id_map(context, map):
-    ob = context.active_object
-
-    bpy.ops.object.mode_set(mode='EDIT')
-    bpy.ops.mesh.select_all(action='DESELECT')
-
-    groups = len(ob.vertex_groups)
-    tmp_mats = []
-    for idx, mat in enumerate(range(groups)):
-        mat = bpy.data.materials.new('_'.join(["mat", str(idx)]))
-        col = colorsys.hsv_to_rgb(random.random(), 1.0, 1.0)
-        mat.diffuse_color = col
-        mat.use_nodes = True
-        map_node = mat.node_tree.nodes.new("ShaderNodeTexImage")
-        map_node.image = map['image']
-        mat.node_tree.nodes.active = map_node
-        if idx is not 0:
-            bpy.ops.object.material_slot_add()
-        ob.material_slots[idx].material = mat
-        tmp_mats.append(mat)
-
-    for vgroup in ob.vertex_groups:
-        idx = vgroup.index
-        ob.vertex_groups.active_index = idx
-        bpy.ops.object.vertex_group_select()
-        ob.active_material_index = idx
-        bpy.ops.object.material_slot_assign()
-        bpy.ops.mesh.select_all(action='DESELECT')
-
-    enable_color_bake_settings()
-    bpy.ops.object.mode_set(mode='OBJECT')
-    bpy.ops.object.bake(type='DIFFUSE')
-
-    for mat in tmp_mats:
-        bpy.data.materials.remove(mat, do_unlink=True)
-        bpy.ops.object.material_slot_remove()
-
-    return map['image']
-
-def ao_map(map):
-    """Returns an image with a baked Ambient Occlusion"""
-    map['mat'].node_tree.nodes.active = map['image_node']
-    bpy.ops.object.bake(type='AO')
-    return map['image']
-
-def position_map(context, map):
-    """Returns an image with a baked position map"""
-    ob = context.active_object
+def analytic_settings(context):
+    """Returns the keyword arguments for the analytic map bakes from the scene settings"""
     scn = context.scene
-    nodes = map['mat'].node_tree.nodes
-    #
-    #Nodes Creation
-    tex_coord = nodes.new("ShaderNodeTexCoord")
-    mapping = nodes.new("ShaderNodeMapping")
-    mapping.rotation[1] = 1.5708 #Radian rotation of 90 degrees in Y
-    mapping.translation[0] = abs(min_vertex(ob.data, 'z'))
-    gr_tex = nodes.new("ShaderNodeTexGradient")
-    #
-    #Nodes linking
-    links = map['mat'].node_tree.links
-    links.new(tex_coord.outputs[3], mapping.inputs[0])
-    links.new(mapping.outputs[0], gr_tex.inputs[0])
-    links.new(gr_tex.outputs[0], map['output'].inputs[0])
-    #
-    #Baking
-    map['mat'].node_tree.nodes.active = map['image_node']
-    enable_color_bake_settings()
-    bpy.ops.object.bake(type='DIFFUSE')
-    return map['image']
-
-def curvature_map(context, map):
-    """Returns an image with a baked curvature map. Map baked on a subdivided version."""
-    original_ob = context.active_object
-    bpy.ops.object.duplicate()
+    return {
+        'direction': maps.axis_direction(scn.position_axis, scn.position_direction),
+        'radius': scn.curvature_radius,
+        'margin': scn.render.bake.margin,
+        'scene': scn if scn.curvature_modifiers else None,
+    }
+
+def bake_settings(context, ob, map_type):
+    """Returns everything besides the mesh itself a bake of map_type for ob depends on"""
+    scn = context.scene
+    settings = gp_cache.scene_settings(scn, ob, map_type)
+    if map_type == 'POS':
+        settings.append(tuple(maps.axis_direction(scn.position_axis, scn.position_direction)))
+    elif map_type == 'CURVE':
+        settings += [scn.curvature_radius, scn.curvature_modifiers]
+        if scn.curvature_modifiers:
+            settings.append(gp_cache.evaluated_digest(ob, scn))
+    return settings
+
+def cache_key(context, ob, map_type, image):
+    """Returns the bake cache fingerprint of baking map_type for ob into image"""
+    settings = bake_settings(context, ob, map_type)
+    return gp_cache.fingerprint(ob, map_type, image.size[0], image.size[1], settings)
+
+def lookup_cache(context, ob, images):
+    """Fills images from the bake cache. Returns a dict of map type -> cache key for the maps that still need baking"""
+    scn = context.scene
+    if not scn.use_bake_cache:
+        return dict.fromkeys(images)
+    gp_cache.set_size(scn.bake_cache_size)
+    gp_cache.set_disk(scn.bake_cache_dir, scn.bake_cache_disk_size)
+    missing = {}
+    with gp_profile.span("Cache lookup", ob):
+        for map_type, image in images.items():
+            if not gp_cache.worth_caching(image, map_type in maps.ANALYTIC_MAPS):
+                missing[map_type] = None
+                continue
+            key = cache_key(context, ob, map_type, image)
+            if not gp_cache.restore(image, key):
+                missing[map_type] = key
+    return missing
+
+def store_cache(images, keys):
+    """Stores freshly baked images under their cache keys"""
+    for map_type, key in keys.items():
+        if key is not None:
+            with gp_profile.span("Cache store"):
+                gp_cache.store(images[map_type], key)
+
+def get_images(ob, width, height, map_types, use_active=False):
+    """Returns a dict of map type -> image to bake into. Existing images of the object are reused"""
+    images = {}
+    for map_type in map_types:
+        #Check for existing image that the user has selected.
+        image = check_img(ob, map_type, use_active)
+        if image is None:
+            #The image of an earlier bake of this map, the bake overwrites it.
+            image = gp_memory.find_image(ob, map_type)
+            if image is not None and tuple(image.size) != (width, height):
+                image.scale(width, height)
+        if image is None:
+            image = get_img(ob, ''.join([ob.name, '_', map_type]), width, height, map_type)
+        images[map_type] = image
+    return images
+
+def render_maps(context, targets, map_type):
+    """Bakes one Cycles map type for several objects in a single bake call. targets is a list of (object, image)"""
+    scn = context.scene
+    scn.render.engine = 'CYCLES'
+
+    #Every selected object bakes into the active image node of its bake material.
+    active = scn.objects.active
+    selected = [ob for ob in scn.objects if ob.select]
+    for ob in selected:
+        ob.select = False
+    for ob, image in targets:
+        ob.select = True
+    scn.objects.active = targets[0][0]
+    try:
+        with gp_bakemat.bound(targets, map_type):
+            with gp_profile.span(''.join(["Cycles ", map_type]), targets[0][0] if len(targets) == 1 else None):
+                bpy.ops.object.bake(type=map_type)
+    finally:
+        for ob, image in targets:
+            ob.select = False
+        for ob in selected:
+            ob.select = True
+        scn.objects.active = active
+    return [image for ob, image in targets]
+
+def render_incremental(context, ob, image):
+    """Re-bakes AO only on the tiles of faces that changed since the last AO bake of ob, and of faces close
+    enough to them to be shaded by them. Returns image"""
+    scn = context.scene
+    margin = scn.render.bake.margin
+    settings = bake_settings(context, ob, 'AO')
+    bounds = gp_incremental.face_bounds(ob)
+    reach = scn.world.light_settings.distance if scn.world else 0.0
+    mask, coverage, digests = gp_incremental.dirty_region(ob, 'AO', image, margin=margin, settings=settings,
+                                                          bounds=bounds, reach=reach)
+    if mask is None:
+        render_maps(context, [(ob, image)], 'AO')
+    elif mask.any():
+        #Faces outside the tiles are moved off the image, Cycles then only bakes around the change.
+        faces = gp_incremental.faces_in(coverage, mask, len(ob.data.polygons), margin)
+        scratch = bpy.data.images.new(image.name + "_dirty", image.size[0], image.size[1], float_buffer=image.is_float)
+        try:
+            with gp_incremental.isolate_faces(ob.data, faces):
+                render_maps(context, [(ob, scratch)], 'AO')
+            gp_incremental.copy_region(scratch, image, mask)
+        finally:
+            bpy.data.images.remove(scratch, do_unlink=True)
+    gp_incremental.remember(ob, 'AO', image, coverage, digests, settings=settings, bounds=bounds)
+    return image
+
+def get_maps(context, width, height, map_types):
+    """Returns a dict of map type -> baked image. The shared setup runs once for all map types"""
     ob = context.active_object
-    bpy.ops.object.modifier_add(type='SUBSURF')
-    subsurf = ob.modifiers[0]
-    subsurf.subdivision_type = 'SIMPLE'
-    
-    ##Subdivides a mesh to a number around 5k+. This is due to curvature being calculated on vertices.
-    while len(ob.data.vertices) < 5000:     #Number is currently an educated guess.
-        bpy.ops.object.mode_set(mode='EDIT')
-        bpy.ops.mesh.subdivide()
-        bpy.ops.object.mode_set(mode='OBJECT')
-
-    bpy.ops.object.mode_set(mode='OBJECT')
-
-    nodes = map['mat'].node_tree.nodes
-    #Nodes Creation
-    geo = nodes.new("ShaderNodeNewGeometry")
-    #Nodes linking
-    links = map['mat'].node_tree.links
-    links.new(geo.outputs[7], map['output'].inputs[0])
-    #Baking
-    map['mat'].node_tree.nodes.active = map['image_node']
-    enable_color_bake_settings()
-    bpy.ops.object.bake(type='DIFFUSE')
-    bpy.ops.object.delete()
-    original_ob.select = True
-    return map['image']
+    #With several maps only labelled nodes count, so the active node isn't relabelled for each of them.
+    images = get_images(ob, width, height, map_types, use_active=len(map_types) == 1)
+    return bake_images(context, ob, images)
+
+def bake_images(context, ob, images):
+    """Bakes every map of a dict of map type -> image at the size of its image. Returns images"""
+    with gp_profile.span("Bake", ob), gp_cache.occluder_memo():
+        scn = context.scene
+        map_types = list(images)
+        keys = lookup_cache(context, ob, images)
+        #Restored and fully baked maps no longer match what was remembered of their last bake.
+        for map_type in map_types:
+            if map_type not in keys or not scn.bake_incremental:
+                gp_incremental.forget(ob, map_type)
+
+        settings = analytic_settings(context)
+        analytic = {t: images[t] for t in keys if t in maps.ANALYTIC_MAPS}
+        if scn.bake_incremental:
+            #Curvature of the evaluated mesh can't be matched to the faces of the base mesh.
+            for map_type in list(analytic):
+                if map_type == 'CURVE' and settings['scene'] is not None:
+                    gp_incremental.forget(ob, map_type)
+                    continue
+                kind, values = maps.map_values(ob, ob.data, map_type, settings['direction'], settings['radius'])
+                gp_incremental.bake_analytic(ob, map_type, analytic.pop(map_type), kind, values, settings['margin'],
+                                             bake_settings(context, ob, map_type))
+
+        #Analytic maps are written straight into the images in one pass over the mesh, without a bake material.
+        if analytic:
+            maps.analytic_maps(ob, analytic, **settings)
+
+        for map_type in map_types:
+            if map_type in keys and map_type not in maps.ANALYTIC_MAPS:
+                if scn.bake_incremental and map_type == 'AO':
+                    render_incremental(context, ob, images[map_type])
+                else:
+                    render_maps(context, [(ob, images[map_type])], map_type)
+        store_cache(images, keys)
+        return images
 
 def get_map(context, width, height, map_type):
     """Returns an image with a baked map depending on the 'type' parameter"""
-    map = dict.fromkeys(['mat', 'output', 'image_node', 'image'])
-    context.scene.render.engine = 'CYCLES'
-    ob = context.active_object
-    if ob.active_material:
-        original_mat = ob.active_material #Might want to handle this!
-        has_mat = True
-    else:
-        has_mat = False
-    
-    #Check for existing image that the user has selected.
-    map['image'] = check_img(ob, map_type)
-
-    map['mat'], map['output'] = create_bake_mat(context, ''.join(['map_', map_type])) #Output is actually a BSDF node
-    ob.active_material = map['mat']
-    map['image_node'] = map['mat'].node_tree.nodes.new("ShaderNodeTexImage")
-    if map['image'] is None:
-        map['image'] = get_img(ob, ''.join([ob.name, '_', map_type]), width, height)
-    map['image_node'].image = map['image']
-
-    if map_type == 'AO':
-        img_map = ao_map(map)
-    elif map_type == 'POS':
-        img_map = position_map(context, map)
-    elif map_type == 'CURVE':
-        img_map = curvature_map(context, map)
-    elif map_type == 'ID':
-        img_map = id_map(context, map)
-    if has_mat:
-        ob.active_material = original_mat
-    bpy.data.materials.remove(map['mat'], do_unlink=True)
-    return img_map
+    return get_maps(context, width, height, [map_type])[map_type]
+
+def progressive_levels(width, height, scale, margin):
+    """Returns the (width, height, margin) of every level of a progressive bake, from 1/scale up to full size"""
+    levels = []
+    while scale >= 1:
+        levels.append((max(1, width // scale), max(1, height // scale), max(1, margin // scale) if margin else 0))
+        scale //= 2
+    return levels
+
+def bake_level(context, ob, images, width, height, margin):
+    """Bakes images at width x height, resizing them first. The previous level is replaced in place"""
+    bake = context.scene.render.bake
+    full_margin = bake.margin
+    for image in images.values():
+        if tuple(image.size) != (width, height):
+            image.scale(width, height)
+    bake.margin = margin
+    try:
+        bake_images(context, ob, images)
+    finally:
+        bake.margin = full_margin
+    return images
+
+def batch_objects(context):
+    """Returns the objects of the bake group, or the selection if no group is set. Returns None if the group is missing"""
+    scn = context.scene
+    if scn.bake_group:
+        group = bpy.data.groups.get(scn.bake_group)
+        if group is None:
+            return None
+        return list(group.objects)
+    return list(context.selected_objects)
+
+def batch_jobs(objects, map_types, width, height):
+    """Returns the bake queue: a (object, map type, width, height) job per map of every mesh object"""
+    return [(ob, map_type, width, height) for ob in objects if ob.type == 'MESH' for map_type in map_types]
+
+def bake_batch(context, jobs):
+    """Runs a queue of bake jobs without making each object active. Returns a dict of object name -> {map type: image}
+    Analytic maps run once per object, Cycles maps once per (map type, resolution) for all objects together"""
+    settings = analytic_settings(context)
+    results = OrderedDict()
+    analytic = OrderedDict()
+    rendered = OrderedDict()
+    baked = []
+    with gp_cache.occluder_memo():
+        for ob, map_type, width, height in jobs:
+            images = get_images(ob, width, height, [map_type])
+            image = images[map_type]
+            results.setdefault(ob.name, {})[map_type] = image
+            keys = lookup_cache(context, ob, images)
+            gp_incremental.forget(ob, map_type)
+            if not keys:
+                continue
+            baked.append((images, keys))
+            if map_type in maps.ANALYTIC_MAPS:
+                analytic.setdefault(ob.name, (ob, {}))[1][map_type] = image
+            else:
+                rendered.setdefault((map_type, width, height), []).append((ob, image))
+
+    for ob, images in analytic.values():
+        with gp_profile.span("Bake", ob):
+            maps.analytic_maps(ob, images, **settings)
+    for (map_type, width, height), targets in rendered.items():
+        render_maps(context, targets, map_type)
+    for images, keys in baked:
+        store_cache(images, keys)
+    return results
 
 class BakeMap(bpy.types.Operator):
     bl_idname = "bake.bake_maps"
@@ -235,6 +329,7 @@ class BakeMap(bpy.types.Operator):
         return context.active_object is not None and rd == 'CYCLES'
 
     def execute(self, context):
+        gp_profile.begin()
         tex_width = context.scene.texture_width
         tex_height = context.scene.texture_height
         bake_type = context.scene.bake_type
@@ -243,7 +338,7 @@ class BakeMap(bpy.types.Operator):
             handle_projection(context)
             ##NEEDS CHANGING!: - Should use own draw method with class properties, and not scene properties.
             map = get_map(context, tex_width, tex_height, bake_type)
-            map.pack(as_png=True)
+            finish_images(context, [map])
             #mat = get_mat(context, ob, map, self.bake_type)
             #ob.active_material = mat
             return {'FINISHED'}
@@ -255,6 +350,252 @@ class BakeMap(bpy.types.Operator):
         layout.prop(self, "width")
         layout.prop(self, "height")
 
+class BakeProgressive(bpy.types.Operator):
+    """Bakes a quick low resolution preview, then refines it to full resolution between UI updates"""
+    bl_idname = "bake.bake_progressive"
+    bl_label = "Bake Progressive"
+    bl_options = {'REGISTER'}
+
+    _timer = None
+
+    @classmethod
+    def poll(cls, context):
+        rd = context.scene.render.engine
+        return context.active_object is not None and rd == 'CYCLES'
+
+    def invoke(self, context, event):
+        gp_profile.begin()
+        scn = context.scene
+        handle_projection(context)
+        self.ob = context.active_object
+        self.size = (scn.texture_width, scn.texture_height)
+        self.images = get_images(self.ob, scn.texture_width, scn.texture_height, [scn.bake_type], use_active=True)
+        self.levels = progressive_levels(scn.texture_width, scn.texture_height, int(scn.preview_scale), scn.render.bake.margin)
+        wm = context.window_manager
+        self._timer = wm.event_timer_add(0.01, context.window)
+        wm.modal_handler_add(self)
+        return {'RUNNING_MODAL'}
+
+    def modal(self, context, event):
+        if event.type == 'ESC':
+            self.finish(context)
+            width, height = list(self.images.values())[0].size
+            #The preview is kept, scaled back to full size and packed like a finished bake.
+            for image in self.images.values():
+                if tuple(image.size) != self.size:
+                    image.scale(*self.size)
+            finish_images(context, self.images.values())
+            self.report({'INFO'}, "Stopped at %dx%d" % (width, height))
+            return {'CANCELLED'}
+        if event.type != 'TIMER':
+            return {'PASS_THROUGH'}
+
+        #One level per timer event, the UI redraws the finished level in between.
+        width, height, margin = self.levels.pop(0)
+        bake_level(context, self.ob, self.images, width, height, margin)
+        for area in context.screen.areas:
+            area.tag_redraw()
+        if self.levels:
+            return {'RUNNING_MODAL'}
+        self.finish(context)
+        finish_images(context, self.images.values())
+        return {'FINISHED'}
+
+    def finish(self, context):
+        context.window_manager.event_timer_remove(self._timer)
+        self._timer = None
+
+class BakeMaps(bpy.types.Operator):
+    """Bakes all the chosen map types of the active object in one go"""
+    bl_idname = "bake.bake_all_maps"
+    bl_label = "Bake Maps"
+    bl_options = {'REGISTER', 'UNDO'}
+
+    @classmethod
+    def poll(cls, context):
+        rd = context.scene.render.engine
+        return context.active_object is not None and rd == 'CYCLES'
+
+    def execute(self, context):
+        gp_profile.begin()
+        scn = context.scene
+        map_types = [t for t in MAP_TYPES if t in scn.bake_types]
+        if not map_types:
+            self.report({'WARNING'}, "No map types chosen")
+            return {'CANCELLED'}
+        handle_projection(context)
+        images = get_maps(context, scn.texture_width, scn.texture_height, map_types)
+        finish_images(context, images.values())
+        return {'FINISHED'}
+
+class BakeBatch(bpy.types.Operator):
+    """Bakes the chosen map types for every selected object, or every object in the bake group"""
+    bl_idname = "bake.bake_batch"
+    bl_label = "Bake Batch"
+    bl_options = {'REGISTER', 'UNDO'}
+
+    @classmethod
+    def poll(cls, context):
+        return context.scene.render.engine == 'CYCLES'
+
+    def execute(self, context):
+        gp_profile.begin()
+        scn = context.scene
+        objects = batch_objects(context)
+        if objects is None:
+            self.report({'WARNING'}, "No group named %s" % scn.bake_group)
+            return {'CANCELLED'}
+        map_types = [t for t in MAP_TYPES if t in scn.bake_types]
+        jobs = batch_jobs(objects, map_types, scn.texture_width, scn.texture_height)
+        if not jobs:
+            self.report({'WARNING'}, "Nothing to bake")
+            return {'CANCELLED'}
+
+        start = time.time()
+        handle_projections(context, [job[0] for job in jobs])
+        results = bake_batch(context, jobs)
+        finish_images(context, [image for images in results.values() for image in images.values()])
+        elapsed = max(time.time() - start, 1e-6)
+        self.report({'INFO'}, "Baked %d maps on %d objects in %.2fs (%.1f objects/sec)" % (
+            len(jobs), len(results), elapsed, len(results) / elapsed))
+        return {'FINISHED'}
+
+def atlas_images(map_types, width, height):
+    """Returns a dict of map type -> shared atlas image, reused between atlas bakes"""
+    images = {}
+    for map_type in map_types:
+        image = bpy.data.images.get(''.join(['Atlas_', map_type]))
+        if image is None:
+            image = get_img(None, ''.join(['Atlas_', map_type]), width, height, map_type)
+        elif tuple(image.size) != (width, height):
+            image.scale(width, height)
+        images[map_type] = image
+    return images
+
+def bake_atlas(context, objects, map_types, width, height):
+    """Packs the objects into one uv atlas and bakes every map once for all of them. Returns the atlas images"""
+    settings = analytic_settings(context)
+    meshes = gp_atlas.apply_layout(objects, settings['margin'], width)
+    objects = [ob for ob in objects if ob.type == 'MESH' and ob.data in meshes]
+    images = atlas_images(map_types, width, height)
+
+    analytic = {t: images[t] for t in map_types if t in maps.ANALYTIC_MAPS}
+    if analytic:
+        maps.atlas_maps(objects, analytic, settings['direction'], settings['radius'], settings['margin'])
+    for map_type in map_types:
+        if map_type not in maps.ANALYTIC_MAPS:
+            #Every object's bake material points at the same image, Cycles writes them all into it.
+            render_maps(context, [(ob, images[map_type]) for ob in objects], map_type)
+    return images
+
+class BakeAtlas(bpy.types.Operator):
+    """Bakes the chosen map types for the batch objects into shared atlas images"""
+    bl_idname = "bake.bake_atlas"
+    bl_label = "Bake Atlas"
+    bl_options = {'REGISTER', 'UNDO'}
+
+    @classmethod
+    def poll(cls, context):
+        return context.scene.render.engine == 'CYCLES'
+
+    def execute(self, context):
+        gp_profile.begin()
+        scn = context.scene
+        objects = batch_objects(context)
+        if objects is None:
+            self.report({'WARNING'}, "No group named %s" % scn.bake_group)
+            return {'CANCELLED'}
+        objects = [ob for ob in objects if ob.type == 'MESH']
+        map_types = [t for t in MAP_TYPES if t in scn.bake_types]
+        if not map_types or not objects:
+            self.report({'WARNING'}, "Nothing to bake")
+            return {'CANCELLED'}
+
+        start = time.time()
+        handle_projections(context, objects)
+        images = bake_atlas(context, objects, map_types, scn.texture_width, scn.texture_height)
+        finish_images(context, images.values())
+        self.report({'INFO'}, "Baked %d maps for %d objects in %.2fs" % (len(images), len(objects), time.time() - start))
+        return {'FINISHED'}
+
+class BakeFarm(bpy.types.Operator):
+    """Bakes the batch in parallel background Blender processes"""
+    bl_idname = "bake.bake_farm"
+    bl_label = "Bake Farm"
+    bl_options = {'REGISTER', 'UNDO'}
+
+    @classmethod
+    def poll(cls, context):
+        return context.scene.render.engine == 'CYCLES'
+
+    def execute(self, context):
+        gp_profile.begin()
+        scn = context.scene
+        objects = batch_objects(context)
+        if objects is None:
+            self.report({'WARNING'}, "No group named %s" % scn.bake_group)
+            return {'CANCELLED'}
+        map_types = [t for t in MAP_TYPES if t in scn.bake_types]
+        if not map_types or not objects:
+            self.report({'WARNING'}, "Nothing to bake")
+            return {'CANCELLED'}
+
+        start = time.time()
+        #Projected here, so the workers' copies and the objects the results go back to share one uv layout.
+        handle_projections(context, objects)
+        folder, results = gp_farm.dispatch(objects, map_types, scn.texture_width, scn.texture_height, scn.farm_workers)
+        try:
+            for name, files in results.items():
+                ob = bpy.data.objects[name]
+                images = get_images(ob, scn.texture_width, scn.texture_height, list(files.keys()))
+                for map_type, filepath in files.items():
+                    gp_farm.load_result(images[map_type], filepath)
+                    gp_incremental.forget(ob, map_type)
+                finish_images(context, images.values())
+        finally:
+            gp_farm.cleanup(folder)
+        elapsed = max(time.time() - start, 1e-6)
+        missing = len([ob for ob in objects if ob.type == 'MESH']) - len(results)
+        if missing:
+            self.report({'WARNING'}, "%d objects failed to bake, see the console" % missing)
+        self.report({'INFO'}, "Baked %d objects in %.2fs (%.1f objects/sec)" % (
+            len(results), elapsed, len(results) / elapsed))
+        return {'FINISHED'}
+
+class FreeImages(bpy.types.Operator):
+    """Frees the images of deleted or hidden objects, least recently used first, until the budget is kept"""
+    bl_idname = "bake.free_images"
+    bl_label = "Free Images"
+
+    def execute(self, context):
+        freed = gp_memory.enforce(context.scene)
+        self.report({'INFO'}, "Freed %.1f MB" % (freed / (1024.0 * 1024.0)))
+        return {'FINISHED'}
+
+class ExportTrace(bpy.types.Operator):
+    """Saves the timed stages of the last bake as Chrome trace events, for chrome://tracing"""
+    bl_idname = "bake.export_trace"
+    bl_label = "Export Trace"
+
+    filepath = StringProperty(subtype='FILE_PATH', default="bake_trace.json")
+
+    def invoke(self, context, event):
+        context.window_manager.fileselect_add(self)
+        return {'RUNNING_MODAL'}
+
+    def execute(self, context):
+        count = gp_profile.export_chrome(bpy.path.abspath(self.filepath))
+        self.report({'INFO'}, "Wrote %d spans to %s" % (count, self.filepath))
+        return {'FINISHED'}
+
+def update_profile(self, context):
+    gp_profile.enable(self.profile_bakes)
+
+@persistent
+def profile_handler(dummy):
+    """The Profile toggle is saved with the file, the flag it sets isn't"""
+    gp_profile.enable(getattr(bpy.context.scene, 'profile_bakes', False))
+
 class BakeMenu(bpy.types.Panel):
     #bl_idname = "bake.bake_menu"
     bl_label = "Baking"
@@ -276,11 +617,73 @@ class BakeMenu(bpy.types.Panel):
         row = layout.row()
         row.prop(scn, "bake_type")
 
+        if scn.bake_type == 'POS' or 'POS' in scn.bake_types:
+            row = layout.row()
+            row.prop(scn, "position_axis")
+            if scn.position_axis == 'CUSTOM':
+                layout.prop(scn, "position_direction")
+        if scn.bake_type == 'CURVE' or 'CURVE' in scn.bake_types:
+            row = layout.row()
+            row.prop(scn, "curvature_radius")
+            row.prop(scn, "curvature_modifiers")
+
         row = layout.row()
         row.prop(cbk, "margin")
+        row = layout.row()
+        row.prop(scn, "projection_mode", expand=True)
+
+        row = layout.row(align=True)
+        row.prop(scn, "use_bake_cache")
+        row.prop(scn, "bake_cache_size")
+        row = layout.row(align=True)
+        row.prop(scn, "bake_cache_dir")
+        row.prop(scn, "bake_cache_disk_size")
+        row = layout.row()
+        row.prop(scn, "bake_incremental")
 
         row = layout.row()
         row.operator("bake.bake_maps", icon='RENDER_STILL')
+        row = layout.row(align=True)
+        row.prop(scn, "preview_scale")
+        row.operator("bake.bake_progressive", icon='RENDER_STILL')
+
+        layout.separator()
+        row = layout.row(align=True)
+        row.prop(scn, "bake_types")
+        row = layout.row()
+        row.operator("bake.bake_all_maps", icon='RENDER_STILL')
+
+        row = layout.row()
+        row.prop_search(scn, "bake_group", bpy.data, "groups")
+        row = layout.row()
+        row.operator("bake.bake_batch", icon='RENDER_STILL')
+
+        row = layout.row()
+        row.operator("bake.bake_atlas", icon='RENDER_STILL')
+
+        row = layout.row(align=True)
+        row.prop(scn, "farm_workers")
+        row.operator("bake.bake_farm", icon='RENDER_STILL')
+
+        layout.separator()
+        row = layout.row(align=True)
+        row.label("Images: %.0f MB" % (gp_memory.usage() / (1024.0 * 1024.0)))
+        row.prop(scn, "image_budget")
+        row.operator("bake.free_images", text="", icon='X')
+
+        row = layout.row(align=True)
+        row.prop(scn, "profile_bakes")
+        row.operator("bake.export_trace", icon='TIME')
+        if scn.profile_bakes:
+            stages, totals = gp_profile.breakdown()
+            for name, rows in stages.items():
+                box = layout.box()
+                box.label("%s: %.3fs" % (name, totals.get(name, 0.0)))
+                col = box.column(align=True)
+                for stage, seconds in rows.items():
+                    row = col.row()
+                    row.label(stage)
+                    row.label("%.3fs" % seconds)
 
 class WidgetUI(bpy.types.Panel):
     bl_idname = "paint.widget_ui"
@@ -326,7 +729,14 @@ class WidgetUI(bpy.types.Panel):
 classes = [
     BakeMenu,
     WidgetUI,
-    BakeMap   
+    BakeMap,
+    BakeProgressive,
+    BakeMaps,
+    BakeBatch,
+    BakeAtlas,
+    BakeFarm,
+    FreeImages,
+    ExportTrace
 ]
 
 def register():
@@ -346,22 +756,117 @@ def register():
         name = "Map ",
         description = "Type of map needed baking for a map",
         default = 'AO',
-        items = [('AO', 'Ambient Occlusion', ''),
-                 ('CURVE', 'Curvature', ''),
-                 ('POS', 'Position', ''),
-                 ('ID', 'ID', '')]
+        items = MAP_ITEMS
+    )
+    bpy.types.Scene.bake_types = EnumProperty(
+        name = "Maps",
+        description = "Map types baked together by Bake Maps",
+        options = {'ENUM_FLAG'},
+        default = {'AO', 'CURVE', 'POS', 'ID'},
+        items = MAP_ITEMS
+    )
+    bpy.types.Scene.bake_group = StringProperty(
+        name = "Group",
+        description = "Bake every object in this group. Uses the selection if empty",
+        default = "",
+    )
+    bpy.types.Scene.farm_workers = IntProperty(
+        name="Workers",
+        description="Number of background Blender processes for the bake farm. 0 uses one per CPU",
+        default=0,
+        min=0,
+    )
+    gp_cache.register_props()
+    bpy.types.Scene.bake_incremental = BoolProperty(
+        name="Incremental",
+        description="Only re-bake the parts of the image covered by faces that changed since the last bake",
+        default=False,
+    )
+    bpy.types.Scene.preview_scale = EnumProperty(
+        name = "Preview",
+        description = "Resolution of the first preview level of a progressive bake",
+        default = '4',
+        items = [('4', '1/4', ''),
+                 ('8', '1/8', '')]
+    )
+    bpy.types.Scene.image_budget = IntProperty(
+        name="Budget MB",
+        description="Memory the baked images may use. Over it, images of deleted or hidden objects are freed",
+        default=gp_memory.DEFAULT_BUDGET,
+        min=0,
+    )
+    bpy.types.Scene.profile_bakes = BoolProperty(
+        name="Profile",
+        description="Time every stage of a bake and show the last bake's timings per object",
+        default=False,
+        update=update_profile,
+    )
+    gp_projection.register_props()
+    bpy.types.Scene.position_axis = EnumProperty(
+        name = "Axis ",
+        description = "Direction of the position gradient, in object space",
+        default = 'Z',
+        items = [('X', 'X', ''),
+                 ('Y', 'Y', ''),
+                 ('Z', 'Z', ''),
+                 ('-X', '-X', ''),
+                 ('-Y', '-Y', ''),
+                 ('-Z', '-Z', ''),
+                 ('CUSTOM', 'Custom', 'Use a custom direction')]
+    )
+    bpy.types.Scene.position_direction = FloatVectorProperty(
+        name = "Direction",
+        description = "Custom direction of the position gradient",
+        subtype = 'DIRECTION',
+        default = (0.0, 0.0, 1.0),
+    )
+    bpy.types.Scene.curvature_radius = IntProperty(
+        name="Smooth",
+        description="Number of edge rings the curvature is smoothed over",
+        default=0,
+        min=0,
+    )
+    bpy.types.Scene.curvature_modifiers = BoolProperty(
+        name="Modifiers",
+        description="Calculate curvature on the mesh with modifiers applied",
+        default=False,
     )
 
     for c in classes:
         bpy.utils.register_class(c)
+    gp.register_handlers()
+    gp_pack.register_handlers()
+    gp_incremental.register_handlers()
+    if profile_handler not in bpy.app.handlers.load_post:
+        bpy.app.handlers.load_post.append(profile_handler)
     
 def unregister():
     del bpy.types.Scene.texture_width
     del bpy.types.Scene.texture_height
     del bpy.types.Scene.bake_type
+    del bpy.types.Scene.bake_types
+    del bpy.types.Scene.bake_group
+    del bpy.types.Scene.farm_workers
+    gp_cache.unregister_props()
+    del bpy.types.Scene.bake_incremental
+    del bpy.types.Scene.preview_scale
+    del bpy.types.Scene.profile_bakes
+    del bpy.types.Scene.image_budget
+    gp_projection.unregister_props()
+    del bpy.types.Scene.position_axis
+    del bpy.types.Scene.position_direction
+    del bpy.types.Scene.curvature_radius
+    del bpy.types.Scene.curvature_modifiers
 
     for c in classes:
         bpy.utils.unregister_class(c)
+    gp.unregister_handlers()
+    gp_pack.unregister_handlers()
+    gp_incremental.unregister_handlers()
+    if profile_handler in bpy.app.handlers.load_post:
+        bpy.app.handlers.load_post.remove(profile_handler)
+    gp_profile.enable(False)
+    gp_bakemat.clear()
     
 if __name__ == '__main__':
     register()
\ No newline at end of file
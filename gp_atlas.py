@@ -0,0 +1,102 @@
+import numpy as np
+import gp_raster as raster
+
+#INFO:
+#       Texture atlases. The uv layout of every object is scaled by its world space surface area, so texel
+#       density matches between objects whatever their scale, and its bounds are packed into one square with a shelf packer. The packed layout is
+#       written to a 'GP_Atlas' uv layer, which becomes the active one, and every map is baked once for all
+#       objects into a shared image.
+
+ATLAS_LAYER = 'GP_Atlas'
+GROWTH = 1.05       #Side of the atlas grows by this much until everything fits.
+MIN_SIZE = 1e-6
+
+def source_layer(mesh):
+    """Returns the uv layer the atlas is made from: the active one, unless that is the atlas itself"""
+    active = mesh.uv_layers.active
+    if active is not None and active.name != ATLAS_LAYER:
+        return active
+    for layer in mesh.uv_layers:
+        if layer.name != ATLAS_LAYER:
+            return layer
+    return None
+
+def island_rect(ob):
+    """Returns the uv bounds (lo, hi) of the object's layout and the scale that gives it world space texel density"""
+    mesh = ob.data
+    uvs = raster.uv_coords(mesh, source_layer(mesh))
+    tris, tri_poly = raster.loop_triangles(mesh)
+    corners = uvs[tris].astype(np.float64)
+    ab = corners[:, 1] - corners[:, 0]
+    ac = corners[:, 2] - corners[:, 0]
+    uv_area = 0.5 * np.abs(ab[:, 0] * ac[:, 1] - ab[:, 1] * ac[:, 0]).sum()
+
+    #Surface area after the object's transform, a scaled object needs more of the atlas.
+    matrix = np.array(ob.matrix_world, dtype=np.float64)
+    co = raster.vertex_coords(mesh) @ matrix[:3, :3].T
+    corners = co[raster.loop_vertices(mesh)[tris]]
+    area = 0.5 * np.linalg.norm(np.cross(corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0]), axis=1).sum()
+    scale = np.sqrt(area / uv_area) if uv_area > MIN_SIZE else 1.0
+    return uvs.min(axis=0), uvs.max(axis=0), scale
+
+def shelf_place(sizes, order, side, pad):
+    """Returns the corner of every rectangle placed on shelves in a square of side, None if they don't fit"""
+    corners = np.empty_like(sizes)
+    x = y = shelf = 0.0
+    for i in order:
+        w, h = sizes[i] + 2.0 * pad
+        if x + w > side:
+            x, y, shelf = 0.0, y + shelf, 0.0
+        if w > side or y + h > side:
+            return None
+        corners[i] = (x + pad, y + pad)
+        x += w
+        shelf = max(shelf, h)
+    return corners
+
+def pack_shelves(sizes, padding=0.0):
+    """Returns the lower left corner of every rectangle (N, 2) and the side of the square they are packed in.
+    Rectangles go tallest first onto shelves. padding is kept around each rectangle, as a fraction of the side"""
+    sizes = np.maximum(np.asarray(sizes, dtype=np.float64), MIN_SIZE)
+    order = np.argsort(-sizes[:, 1], kind='stable')
+    side = max(np.sqrt((sizes[:, 0] * sizes[:, 1]).sum()), sizes.max())
+    padding = min(padding, 0.25)
+    while True:
+        corners = shelf_place(sizes, order, side, padding * side)
+        if corners is not None:
+            return corners, side
+        side *= GROWTH
+
+def atlas_layer(mesh):
+    """Returns the atlas uv layer of mesh, made the active one. Created from the source layout if missing"""
+    layer = mesh.uv_layers.get(ATLAS_LAYER)
+    if layer is None:
+        mesh.uv_textures.new(name=ATLAS_LAYER)
+        layer = mesh.uv_layers[ATLAS_LAYER]
+    texture = mesh.uv_textures[ATLAS_LAYER]
+    mesh.uv_textures.active = texture
+    texture.active_render = True
+    return layer
+
+def apply_layout(objects, margin, width):
+    """Packs the uv layouts of objects into one atlas and writes it to their atlas layers. Returns the meshes
+    margin is in pixels of an atlas image width wide, it is kept free around every object"""
+    meshes = []
+    owners = []
+    for ob in objects:
+        if ob.type == 'MESH' and ob.data not in meshes and source_layer(ob.data) is not None:
+            meshes.append(ob.data)
+            owners.append(ob)
+    if not meshes:
+        return meshes
+
+    #Linked duplicates share one layout, sized by the first of them.
+    rects = [island_rect(ob) for ob in owners]
+    sizes = [(hi - lo) * scale for lo, hi, scale in rects]
+    corners, side = pack_shelves(sizes, float(margin) / width)
+    for mesh, (lo, hi, scale), corner in zip(meshes, rects, corners):
+        uvs = raster.uv_coords(mesh, source_layer(mesh))
+        uvs = ((uvs - lo) * scale + corner) / side
+        atlas_layer(mesh).data.foreach_set('uv', uvs.astype(np.float32).ravel())
+        mesh.update()
+    return meshes
@@ -0,0 +1,108 @@
+import bpy
+from contextlib import contextmanager
+import gp_profile
+
+#INFO:
+#       Pool of bake materials. Cycles bakes into the active image node of every material on the object, so
+#       a bake swaps the object's materials for a template with an image node pointing at the target image.
+#       Templates are kept per map type and rebound to each new image instead of being built and removed
+#       for every bake. The object's own materials are put back when the bake ends, also when it fails.
+#       Templates have no fake user, Blender drops them when the file is saved.
+
+TAG = 'GP_bake'         #Map type a template material bakes.
+PREFIX = 'GP_Bake_'
+OUTPUT = 'out'          #Diffuse BSDF of the template, the bake output.
+TARGET = 'target'       #Image node the bake is written into.
+
+_BUSY = set()   #Names of templates bound to an image right now
+
+def build(mat):
+    """Sets up the nodes of a template material. Returns the image node"""
+    mat.use_nodes = True
+    nodes = mat.node_tree.nodes
+    out_node = nodes.get(OUTPUT) or nodes.get('Diffuse BSDF')
+    if out_node is None:
+        nodes.clear()
+        out_node = nodes.new('ShaderNodeBsdfDiffuse')
+        output = nodes.new('ShaderNodeOutputMaterial')
+        mat.node_tree.links.new(out_node.outputs[0], output.inputs[0])
+    out_node.name = OUTPUT
+    image_node = nodes.get(TARGET)
+    if image_node is None or image_node.type != 'TEX_IMAGE':
+        image_node = nodes.new('ShaderNodeTexImage')
+        image_node.name = TARGET
+    return image_node
+
+def is_template(mat):
+    return mat.get(TAG) is not None
+
+def acquire(map_type, image):
+    """Returns a free template for map_type with its image node bound to image, made if the pool has none"""
+    for mat in bpy.data.materials:
+        if mat.get(TAG) == map_type and mat.name not in _BUSY and mat.library is None:
+            break
+    else:
+        with gp_profile.span("Bake material"):
+            mat = bpy.data.materials.new(''.join([PREFIX, map_type]))
+            mat[TAG] = map_type
+    image_node = build(mat)
+    image_node.image = image
+    mat.node_tree.nodes.active = image_node
+    _BUSY.add(mat.name)
+    return mat
+
+def release(mat):
+    """Unbinds the template's image, so it doesn't keep the image in use, and returns it to the pool"""
+    _BUSY.discard(mat.name)
+    image_node = mat.node_tree.nodes.get(TARGET)
+    if image_node is not None:
+        image_node.image = None
+
+def assign(ob, mat, restore):
+    """Puts mat in every material slot of ob. Appends what it takes to put back to restore.
+    Slots are linked to the object for the bake, so linked duplicates sharing the mesh keep their own template"""
+    if len(ob.material_slots) == 0:
+        ob.data.materials.append(mat)
+        restore.append((ob, None, None, None))
+        return
+    for index, slot in enumerate(ob.material_slots):
+        link = slot.link
+        slot.link = 'OBJECT'
+        restore.append((ob, index, link, slot.material))
+        slot.material = mat
+
+def put_back(restore):
+    """Puts the materials and slot links of restore back, last change first"""
+    for ob, index, link, mat in reversed(restore):
+        if index is None:
+            ob.data.materials.pop(index=len(ob.data.materials) - 1)
+        else:
+            slot = ob.material_slots[index]
+            slot.material = mat
+            slot.link = link
+
+@contextmanager
+def bound(targets, map_type):
+    """Swaps the materials of every object in targets, a list of (object, image), for templates baking map_type
+    into its image. Yields the templates in the order of targets. Objects baking into the same image share one"""
+    by_image = {}
+    templates = []
+    restore = []
+    try:
+        for ob, image in targets:
+            mat = by_image.get(image.name)
+            if mat is None:
+                mat = by_image[image.name] = acquire(map_type, image)
+            assign(ob, mat, restore)
+            templates.append(mat)
+        yield templates
+    finally:
+        put_back(restore)
+        for mat in by_image.values():
+            release(mat)
+
+def clear():
+    """Removes every template not in use"""
+    for mat in list(bpy.data.materials):
+        if is_template(mat) and mat.name not in _BUSY and mat.library is None:
+            bpy.data.materials.remove(mat, do_unlink=True)
@@ -0,0 +1,268 @@
+import bpy
+import argparse
+import json
+import os
+import resource
+import sys
+import time
+import numpy as np
+
+if __name__ == '__main__':
+    #Run as a script, so the add-on folder isn't on the path yet.
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import gp_cache
+import gp_pack
+import gp_projection
+import gp_raster as raster
+import gp_utils as gp
+import gp_ramp
+
+#INFO:
+#       Bake benchmark. Runs headless:
+#           blender -b -P gp_bench.py -- --out results.json
+#           blender -b -P gp_bench.py -- --out results.json --compare baseline.json
+#       Bakes every map type(AO, POS, CURVE, ID and the GPTEX output) on synthetic grids of 1k to 1M faces and
+#       on bridge_demo.fbx, at 256 to 4096. Records wall time, peak RSS and image memory per run.
+#       Caches, coverage indices, ramp LUTs and masters are cleared and pending packs flushed before every run,
+#       so every bake starts from scratch. GPTEX times the ramp only, its mask is baked before the timer starts.
+#       Peak RSS is reset before every run on Linux. Where it can't be, the process peak so far is
+#       recorded instead and the result says so in 'peak_rss_scope'.
+
+FACES = [1000, 10000, 100000, 1000000]
+SIZES = [256, 512, 1024, 2048, 4096]
+MAPS = ['AO', 'POS', 'CURVE', 'ID', 'GPTEX']
+DEMO = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bridge_demo.fbx")
+THRESHOLD = 0.10    #Slowdown over the baseline counted as a regression.
+MIN_DELTA = 0.05    #Seconds. Smaller differences are noise.
+
+####################################
+####    MESHES
+#
+
+def grid_mesh(name, faces):
+    """Returns a wavy grid object of about faces quads, with a uv layout covering 0-1"""
+    side = max(1, int(round(np.sqrt(faces))))
+    n = side + 1
+    x, y = np.meshgrid(np.linspace(0.0, 1.0, n), np.linspace(0.0, 1.0, n))
+    z = 0.05 * np.sin(x * 12.0) * np.cos(y * 9.0)
+    co = np.stack((x, y, z), axis=-1).reshape(-1, 3)
+
+    i, j = np.meshgrid(np.arange(side), np.arange(side))
+    first = (j * n + i).ravel()
+    quads = np.stack((first, first + 1, first + n + 1, first + n), axis=1)
+
+    mesh = bpy.data.meshes.new(name)
+    mesh.vertices.add(len(co))
+    mesh.vertices.foreach_set('co', co.astype(np.float32).ravel())
+    mesh.loops.add(quads.size)
+    mesh.loops.foreach_set('vertex_index', quads.ravel().astype(np.int32))
+    mesh.polygons.add(len(quads))
+    mesh.polygons.foreach_set('loop_start', (np.arange(len(quads)) * 4).astype(np.int32))
+    mesh.polygons.foreach_set('loop_total', np.full(len(quads), 4, dtype=np.int32))
+    mesh.update(calc_edges=True)
+    mesh.uv_textures.new()
+    mesh.uv_layers.active.data.foreach_set('uv', co[quads.ravel(), :2].astype(np.float32).ravel())
+
+    ob = bpy.data.objects.new(name, mesh)
+    bpy.context.scene.objects.link(ob)
+    return ob
+
+def demo_mesh(context):
+    """Returns bridge_demo.fbx imported and joined into one object, None if the file is missing"""
+    if not os.path.exists(DEMO):
+        return None
+    before = set(bpy.data.objects)
+    bpy.ops.import_scene.fbx(filepath=DEMO)
+    objects = [ob for ob in bpy.data.objects if ob not in before and ob.type == 'MESH']
+    if not objects:
+        return None
+    scn = context.scene
+    for ob in scn.objects:
+        ob.select = ob in objects
+    scn.objects.active = objects[0]
+    if len(objects) > 1:
+        bpy.ops.object.join()
+    ob = scn.objects.active
+    ob.name = "bridge_demo"
+    if len(ob.data.uv_textures) == 0:
+        import GameTexTools as gtt
+        gtt.handle_projection(context)
+    return ob
+
+####################################
+####    RUNS
+#
+
+def image_memory():
+    """Returns the megabytes held by image buffers"""
+    total = 0
+    for image in bpy.data.images:
+        if image.has_data:
+            width, height = image.size
+            total += width * height * image.channels * (4 if image.is_float else 1)
+    return total / (1024.0 * 1024.0)
+
+def reset_peak_rss():
+    """Resets the peak resident memory of the process. Returns False where that isn't supported"""
+    try:
+        with open("/proc/self/clear_refs", 'w') as f:
+            f.write("5")
+    except (IOError, OSError):
+        return False
+    return True
+
+def peak_rss():
+    """Returns the peak resident memory since the last reset(or of the whole process), in megabytes"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024.0
+    except (IOError, OSError):
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+def clear_caches():
+    """Drops cached bakes, coverage indices, ramp LUTs and Gradient Painter's masters, so every run bakes from scratch"""
+    gp_cache.MEMORY.clear()
+    gp_cache.DISK = None
+    gp_projection.clear_cache()
+    raster.clear_cache()
+    gp_ramp.clear_cache()
+    for image in list(bpy.data.images):
+        if str(image.get('mask', '')).endswith('_MASTER'):
+            gp.unregister_item('IMG', image)
+            bpy.data.images.remove(image, do_unlink=True)
+
+def prepare_gptex(context, ob, size):
+    """Bakes the POS mask a GPTEX image is made from. Returns the ramp node and the mask"""
+    import gradient_painter as painter
+    gp.check_id(context, ob)
+    mask = painter.get_mask(context, size, size, 'POS')
+    mat = painter.get_mat(context, ob, mask, 'POS')
+    ob.active_material = mat
+    return painter.get_ramp_mask(mat)
+
+def bake_gptex(ob, ramp, mask, size):
+    """Runs the mask through the ramp into a GPTEX image, the way Gradient Painter's Bake Texture does"""
+    target = bpy.data.images.new(ob.name + "_GPTEX", size, size)
+    gp_ramp.ramp_image(ramp.color_ramp, mask, target)
+    return [target]
+
+def prepare(context, ob, map_type, size):
+    """Does the untimed part of a run. Returns the timed part, a function returning the images it made,
+    and the images made so far"""
+    import GameTexTools as gtt
+    if map_type == 'GPTEX':
+        ramp, mask = prepare_gptex(context, ob, size)
+        return (lambda: bake_gptex(ob, ramp, mask, size)), [mask]
+    return (lambda: list(gtt.get_maps(context, size, size, [map_type]).values())), []
+
+def bench(context, ob, map_types, sizes, repeat=1):
+    """Returns a result per map type and size baked on ob"""
+    scn = context.scene
+    for other in scn.objects:
+        other.select = other is ob
+    scn.objects.active = ob
+    faces = len(ob.data.polygons)
+    results = []
+    for map_type in map_types:
+        for size in sorted(sizes):
+            times = []
+            peaks = []
+            for i in range(repeat):
+                bake, images = prepare(context, ob, map_type, size)
+                gp_pack.flush(wait=True)
+                clear_caches()
+                scope = 'run' if reset_peak_rss() else 'process'
+                start = time.perf_counter()
+                images += bake()
+                times.append(time.perf_counter() - start)
+                peaks.append(peak_rss())
+                memory = image_memory()
+                for image in images:
+                    bpy.data.images.remove(image, do_unlink=True)
+            result = {
+                'mesh': ob.name,
+                'faces': faces,
+                'map': map_type,
+                'size': size,
+                'seconds': min(times),
+                'peak_rss_mb': max(peaks),
+                'peak_rss_scope': scope,
+                'image_mb': memory,
+            }
+            print("%-12s %8d faces  %-5s %5d  %8.3fs  %8.1f MB %s peak RSS  %7.1f MB images" % (
+                ob.name, faces, map_type, size, result['seconds'], result['peak_rss_mb'], scope, result['image_mb']))
+            results.append(result)
+    return results
+
+####################################
+####    COMPARE
+#
+
+def compare(results, baseline, threshold=THRESHOLD):
+    """Returns the results that are slower than the baseline by more than threshold"""
+    old = {(r['mesh'], r['map'], r['size']): r for r in baseline['results']}
+    regressions = []
+    for result in results:
+        before = old.get((result['mesh'], result['map'], result['size']))
+        if before is None:
+            continue
+        delta = result['seconds'] - before['seconds']
+        if delta > MIN_DELTA and result['seconds'] > before['seconds'] * (1.0 + threshold):
+            regressions.append(dict(result, baseline=before['seconds']))
+    return regressions
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(prog="blender -b -P gp_bench.py --")
+    parser.add_argument("--out", default="gp_bench.json", help="File the results are written to")
+    parser.add_argument("--compare", default="", help="Baseline results to flag regressions against")
+    parser.add_argument("--threshold", type=float, default=THRESHOLD, help="Slowdown counted as a regression, 0.1 is 10%%")
+    parser.add_argument("--faces", type=int, nargs='*', default=FACES)
+    parser.add_argument("--sizes", type=int, nargs='*', default=SIZES)
+    parser.add_argument("--maps", nargs='*', default=MAPS, choices=MAPS)
+    parser.add_argument("--repeat", type=int, default=1, help="Runs per bake, the fastest counts")
+    parser.add_argument("--no-demo", action='store_true', help="Skip bridge_demo.fbx")
+    return parser.parse_args(argv)
+
+def main(argv):
+    args = parse_args(argv)
+    import GameTexTools as gtt
+    if not hasattr(bpy.types.Scene, 'bake_types'):
+        gtt.register()
+    context = bpy.context
+    scn = context.scene
+    scn.render.engine = 'CYCLES'
+    scn.use_bake_cache = False
+    scn.bake_incremental = False
+
+    objects = [grid_mesh("grid_%d" % faces, faces) for faces in args.faces]
+    if not args.no_demo:
+        demo = demo_mesh(context)
+        if demo is not None:
+            objects.append(demo)
+
+    results = []
+    for ob in objects:
+        results += bench(context, ob, args.maps, args.sizes, args.repeat)
+    with open(args.out, 'w') as f:
+        json.dump({
+            'blender': bpy.app.version_string,
+            'date': time.strftime("%Y-%m-%d %H:%M:%S"),
+            'results': results,
+        }, f, indent=1)
+    print("Wrote", args.out)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        for r in regressions:
+            print("REGRESSION %s %s %d: %.3fs, was %.3fs" % (r['mesh'], r['map'], r['size'], r['seconds'], r['baseline']))
+        if regressions:
+            sys.exit(1)
+        print("No regressions against", args.compare)
+
+if __name__ == '__main__':
+    main(sys.argv[sys.argv.index("--") + 1:] if "--" in sys.argv else [])
@@ -0,0 +1,318 @@
+import bpy
+import hashlib
+import os
+import tempfile
+import time
+import numpy as np
+from collections import OrderedDict
+from contextlib import contextmanager
+from bpy.props import BoolProperty, IntProperty, StringProperty
+import gp_raster as raster
+import gp_pixels as px
+
+#INFO:
+#       Content addressed cache of bake results. A bake is keyed by a fingerprint of everything it depends on:
+#       vertex positions, topology, the uv layer, map type, resolution and bake settings. On a hit the stored
+#       pixels are written back into the image and the bake is skipped.
+#       Optionally backed by a folder on disk, so bakes survive the session and are shared between
+#       Blender processes on the same machine.
+
+DEFAULT_SIZE = 256          #MB
+DEFAULT_DISK_SIZE = 2048    #MB
+LOCK_TIMEOUT = 60           #Seconds before an eviction lock left by a crashed process is ignored.
+
+class BakeCache:
+    """In-memory LRU of fingerprint -> pixel buffer, bounded in bytes"""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        pixels = self.entries.get(key)
+        if pixels is not None:
+            self.entries.move_to_end(key)
+        return pixels
+
+    def put(self, key, pixels):
+        if pixels.nbytes > self.max_bytes:
+            return
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.size -= old.nbytes
+        self.entries[key] = pixels
+        self.size += pixels.nbytes
+        self.evict()
+
+    def evict(self):
+        while self.size > self.max_bytes and self.entries:
+            key, pixels = self.entries.popitem(last=False)
+            self.size -= pixels.nbytes
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+
+class DiskCache:
+    """Folder of fingerprint.npy files, bounded in bytes. Least recently used files are removed first.
+    Files are written to a temp name and renamed into place, so readers in other processes never see half a file.
+    The folder is only scanned when the size counted since the last scan goes over the limit"""
+
+    def __init__(self, folder, max_bytes):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.size = None    #Bytes in the folder as of the last scan plus what was written since. None before a scan
+
+    def path(self, key):
+        return os.path.join(self.folder, key[:2], key + ".npy")
+
+    def get(self, key):
+        path = self.path(key)
+        try:
+            pixels = np.load(path, allow_pickle=False)
+            os.utime(path, None)    #Mark as recently used.
+        except (IOError, OSError, ValueError):
+            return None
+        return pixels
+
+    def put(self, key, pixels):
+        path = self.path(key)
+        folder = os.path.dirname(path)
+        try:
+            os.makedirs(folder, exist_ok=True)
+            handle, tmp = tempfile.mkstemp(dir=folder, suffix=".tmp")
+            with os.fdopen(handle, 'wb') as f:
+                np.save(f, pixels, allow_pickle=False)
+            written = os.path.getsize(tmp)
+            os.replace(tmp, path)
+        except (IOError, OSError):
+            return
+        if self.size is not None:
+            self.size += written
+        if self.size is None or self.size > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        """Removes the least recently used files until the folder fits. Skipped if another process is at it"""
+        lock = os.path.join(self.folder, "evict.lock")
+        try:
+            fd = os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except OSError:
+            try:
+                if time.time() - os.path.getmtime(lock) > LOCK_TIMEOUT:
+                    os.remove(lock)
+            except OSError:
+                pass
+            return
+        try:
+            files = []
+            total = 0
+            for sub in os.listdir(self.folder):
+                sub = os.path.join(self.folder, sub)
+                if not os.path.isdir(sub):
+                    continue
+                for name in os.listdir(sub):
+                    if not name.endswith(".npy"):
+                        continue
+                    path = os.path.join(sub, name)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    files.append((stat.st_mtime, stat.st_size, path))
+                    total += stat.st_size
+            files.sort()
+            for mtime, size, path in files:
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                    total -= size
+                except OSError:
+                    pass
+            self.size = total
+        finally:
+            os.close(fd)
+            try:
+                os.remove(lock)
+            except FileNotFoundError:
+                pass    #Taken for stale and removed by another process.
+
+MEMORY = BakeCache(DEFAULT_SIZE * 1024 * 1024)
+DISK = None
+_OCCLUDERS = None   #Mesh pointer -> vertex digest, while inside occluder_memo()
+_PROP_USERS = 0     #Add-ons that registered the scene properties. They stay until the last one unregisters.
+
+####################################
+####    PROPERTIES
+#
+
+def register_props():
+    """Adds the cache settings to the scene. Both add-ons call it, the settings are shared"""
+    global _PROP_USERS
+    _PROP_USERS += 1
+    if hasattr(bpy.types.Scene, 'use_bake_cache'):
+        return
+    bpy.types.Scene.use_bake_cache = BoolProperty(
+        name="Cache",
+        description="Reuse earlier bakes when the mesh, uvs and settings haven't changed",
+        default=True,
+    )
+    bpy.types.Scene.bake_cache_size = IntProperty(
+        name="MB",
+        description="Memory used by the bake cache, least recently used bakes are dropped first",
+        default=DEFAULT_SIZE,
+        min=0,
+    )
+    bpy.types.Scene.bake_cache_dir = StringProperty(
+        name="Disk",
+        description="Folder to keep bakes in between sessions and Blender processes. Empty to keep them in memory only",
+        subtype='DIR_PATH',
+        default="",
+    )
+    bpy.types.Scene.bake_cache_disk_size = IntProperty(
+        name="MB",
+        description="Disk space used by the bake cache folder",
+        default=DEFAULT_DISK_SIZE,
+        min=0,
+    )
+
+def unregister_props():
+    global _PROP_USERS
+    _PROP_USERS = max(_PROP_USERS - 1, 0)
+    if _PROP_USERS or not hasattr(bpy.types.Scene, 'use_bake_cache'):
+        return
+    del bpy.types.Scene.use_bake_cache
+    del bpy.types.Scene.bake_cache_size
+    del bpy.types.Scene.bake_cache_dir
+    del bpy.types.Scene.bake_cache_disk_size
+
+####################################
+####    FINGERPRINTS
+#
+
+def mesh_digest(mesh):
+    """Returns a hash object fed with the mesh's positions, topology and active uv layer"""
+    digest = hashlib.md5()
+    digest.update(raster.vertex_coords(mesh).tobytes())
+    digest.update(raster.loop_vertices(mesh).tobytes())
+    loop_total = raster.int_array(mesh.polygons, 'loop_total', len(mesh.polygons))
+    digest.update(loop_total.tobytes())
+    if mesh.uv_layers.active is not None:
+        digest.update(mesh.uv_layers.active.name.encode())
+        digest.update(raster.uv_coords(mesh).tobytes())
+    return digest
+
+def vertex_digest(mesh):
+    """Returns a hash of the mesh's vertex positions"""
+    return hashlib.md5(raster.vertex_coords(mesh).tobytes()).hexdigest()
+
+@contextmanager
+def occluder_memo():
+    """Hashes every occluder mesh only once inside the block. Wrap a whole bake run in it, meshes mustn't change"""
+    global _OCCLUDERS
+    if _OCCLUDERS is not None:
+        yield
+        return
+    _OCCLUDERS = {}
+    try:
+        yield
+    finally:
+        _OCCLUDERS = None
+
+def evaluated_digest(ob, scene):
+    """Returns a hash of the object's mesh with its modifiers applied"""
+    mesh = ob.to_mesh(scene, True, 'PREVIEW')
+    try:
+        return mesh_digest(mesh).hexdigest()
+    finally:
+        bpy.data.meshes.remove(mesh)
+
+def scene_settings(scene, ob, map_type):
+    """Returns the scene state a Cycles map depends on besides the mesh itself"""
+    settings = [
+        scene.render.bake.margin,
+        getattr(getattr(scene, 'cycles', None), 'samples', None),
+    ]
+    if map_type == 'AO':
+        light = scene.world.light_settings if scene.world else None
+        settings += [
+            light.distance if light else None,
+            tuple(tuple(row) for row in ob.matrix_world),
+        ]
+        #Occluders, by their vertices and where they are. Linked duplicates share a digest.
+        digests = _OCCLUDERS if _OCCLUDERS is not None else {}
+        for other in scene.objects:
+            if other is not ob and other.type == 'MESH' and other.is_visible(scene):
+                pointer = other.data.as_pointer()
+                if pointer not in digests:
+                    digests[pointer] = vertex_digest(other.data)
+                settings.append((other.name, digests[pointer], tuple(tuple(row) for row in other.matrix_world)))
+    return settings
+
+def fingerprint(ob, map_type, width, height, settings):
+    """Returns the cache key of baking map_type for ob at width x height. settings is anything else the map depends on"""
+    digest = mesh_digest(ob.data)
+    if map_type == 'ID':
+        digest.update(repr(sorted((v.index, g.group, g.weight) for v in ob.data.vertices for g in v.groups)).encode())
+        digest.update(repr(len(ob.vertex_groups)).encode())
+    digest.update(repr((map_type, width, height, settings)).encode())
+    return digest.hexdigest()
+
+####################################
+####    LOOKUP
+#
+
+def encode(image, pixels):
+    """Byte images are stored as bytes, at a quarter of the size"""
+    if image.is_float:
+        return pixels
+    return np.rint(pixels * 255.0).astype(np.uint8)
+
+def decode(pixels):
+    if pixels.dtype == np.uint8:
+        return pixels.astype(np.float32) / 255.0
+    return pixels
+
+def worth_caching(image, analytic):
+    """Returns False if restoring image would cost more than baking it: analytic maps when pixels can only be
+    moved through the sequence path"""
+    return px.is_fast(image) or not analytic
+
+def restore(image, key):
+    """Writes cached pixels for key into image. Returns True on a hit"""
+    pixels = MEMORY.get(key)
+    if pixels is None and DISK is not None:
+        pixels = DISK.get(key)
+        if pixels is not None:
+            MEMORY.put(key, pixels)
+    if pixels is None:
+        return False
+    width, height = image.size
+    if pixels.shape[:2] != (height, width):
+        return False
+    px.write(image, decode(pixels))
+    return True
+
+def store(image, key):
+    """Stores the pixels of a freshly baked image under key"""
+    pixels = encode(image, px.read(image))
+    MEMORY.put(key, pixels)
+    if DISK is not None:
+        DISK.put(key, pixels)
+
+def set_size(megabytes):
+    MEMORY.max_bytes = megabytes * 1024 * 1024
+    MEMORY.evict()
+
+def set_disk(folder, megabytes=DEFAULT_DISK_SIZE):
+    """Uses folder as the on-disk cache. An empty folder turns the disk cache off"""
+    global DISK
+    if not folder:
+        DISK = None
+        return
+    folder = bpy.path.abspath(folder)
+    if DISK is None or DISK.folder != folder:
+        DISK = DiskCache(folder, megabytes * 1024 * 1024)
+    DISK.max_bytes = megabytes * 1024 * 1024
@@ -0,0 +1,139 @@
+import bpy
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+if __name__ == '__main__':
+    #Workers run this file as a script, so the add-on folder isn't on the path yet.
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import gp_pixels as px
+
+#INFO:
+#       Bake farm. Splits a batch bake into shards and runs each in its own background Blender
+#       (blender -b <copy of the file> -P gp_farm.py -- <job.json>). Workers bake with GameTexTools' batch
+#       entry point, save the images to a temp folder and the dispatcher copies them back into the file.
+#       Only needs CPU Cycles and a Blender binary, so it runs headless on a plain Linux box.
+
+MANIFEST = "manifest.json"
+
+def worker_count():
+    """Returns the default number of workers: one per CPU"""
+    return max(1, os.cpu_count() or 1)
+
+def split(names, count):
+    """Returns names split into at most count round-robin shards"""
+    count = max(1, min(count, len(names)))
+    return [names[i::count] for i in range(count)]
+
+####################################
+####    DISPATCHER
+#
+
+def dispatch(objects, map_types, width, height, workers=0):
+    """Bakes map_types for objects in parallel background workers.
+    Returns the temp folder and a dict of object name -> {map type: image file}. Remove the folder with cleanup()"""
+    workers = workers or worker_count()
+    names = [ob.name for ob in objects if ob.type == 'MESH']
+    shards = split(names, workers)
+    threads = max(1, worker_count() // len(shards))
+
+    folder = tempfile.mkdtemp(prefix="gp_farm_")
+    blend = os.path.join(folder, "scene.blend")
+    bpy.ops.wm.save_as_mainfile(filepath=blend, copy=True)
+
+    procs = []
+    for i, shard in enumerate(shards):
+        out = os.path.join(folder, "shard_%d" % i)
+        os.makedirs(out)
+        job_path = os.path.join(out, "job.json")
+        with open(job_path, 'w') as f:
+            json.dump({
+                'scene': bpy.context.scene.name,
+                'objects': shard,
+                'maps': list(map_types),
+                'width': width,
+                'height': height,
+                'threads': threads,
+                'out': out,
+            }, f)
+        log = open(os.path.join(out, "log.txt"), 'w')
+        cmd = [bpy.app.binary_path, "-b", blend, "-P", os.path.abspath(__file__), "--", job_path]
+        procs.append((subprocess.Popen(cmd, stdout=log, stderr=subprocess.STDOUT), log, out))
+
+    results = {}
+    failed = []
+    for proc, log, out in procs:
+        proc.wait()
+        log.close()
+        manifest = os.path.join(out, MANIFEST)
+        if proc.returncode != 0 or not os.path.exists(manifest):
+            failed.append(os.path.join(out, "log.txt"))
+            continue
+        with open(manifest) as f:
+            for name, files in json.load(f).items():
+                results[name] = {map_type: os.path.join(out, filename) for map_type, filename in files.items()}
+    if failed:
+        print("Bake farm workers failed, see:", ", ".join(failed))
+    return folder, results
+
+def load_result(image, filepath):
+    """Copies the pixels of a baked file into image. Returns image"""
+    baked = bpy.data.images.load(filepath)
+    try:
+        if tuple(baked.size) != tuple(image.size):
+            image.scale(baked.size[0], baked.size[1])
+        px.write(image, px.read(baked, 'farm'))
+    finally:
+        bpy.data.images.remove(baked, do_unlink=True)
+    return image
+
+def cleanup(folder):
+    shutil.rmtree(folder, ignore_errors=True)
+
+####################################
+####    WORKER
+#
+
+def worker_main(job_path):
+    """Entry point of a background worker. Bakes its shard and writes a manifest of the saved images"""
+    import GameTexTools as gtt
+    if not hasattr(bpy.types.Scene, 'bake_types'):
+        gtt.register()
+
+    with open(job_path) as f:
+        job = json.load(f)
+    context = bpy.context
+    scn = bpy.data.scenes[job['scene']]
+    scn.render.threads_mode = 'FIXED'
+    scn.render.threads = job['threads']
+
+    objects = [scn.objects[name] for name in job['objects'] if name in scn.objects]
+    jobs = gtt.batch_jobs(objects, job['maps'], job['width'], job['height'])
+    gtt.handle_projections(context, objects)
+    results = gtt.bake_batch(context, jobs)
+
+    manifest = {}
+    for i, (name, images) in enumerate(results.items()):
+        files = {}
+        for map_type, image in images.items():
+            #Object names aren't safe file names, so files are numbered.
+            filename = "%d_%s.png" % (i, map_type)
+            #Saved through a copy, the baked image might be packed or point at a user file.
+            out = bpy.data.images.new(filename, image.size[0], image.size[1])
+            px.write(out, px.read(image, 'farm'))
+            out.filepath_raw = os.path.join(job['out'], filename)
+            out.file_format = 'PNG'
+            out.save()
+            files[map_type] = filename
+        manifest[name] = files
+    with open(os.path.join(job['out'], MANIFEST), 'w') as f:
+        json.dump(manifest, f)
+
+if __name__ == '__main__':
+    argv = sys.argv[sys.argv.index("--") + 1:] if "--" in sys.argv else []
+    if argv:
+        worker_main(argv[0])
@@ -0,0 +1,282 @@
+import bpy
+import numpy as np
+from collections import OrderedDict
+from contextlib import contextmanager
+from bpy.app.handlers import persistent
+import gp_raster as raster
+import gp_maps as maps
+import gp_pixels as px
+import gp_profile
+
+#INFO:
+#       Incremental re-baking. After every bake of an (object, map type) the per-face digests of positions
+#       and uvs are remembered, together with the map's values and coverage index. The next bake only
+#       rewrites the tiles covered by faces that changed since then, plus the bake margin. Anything else the
+#       bake depends on(margin, AO distance, samples, transform, occluders) is remembered as its settings,
+#       when those change the whole map is baked again.
+#       AO of a face also depends on the geometry around it. Faces within the AO distance of a changed face,
+#       where it was or where it is now, are re-baked with it.
+#       Analytic maps are recomputed on those tiles only. AO is re-baked by Cycles with every face
+#       outside the tiles moved off the image, so the render only pays for the affected area.
+
+TILE = 32
+OFF_IMAGE = -8.0    #UV coordinate far outside 0-1, Cycles skips faces there.
+STATE_SIZE = 1024   #MB of remembered bakes. A 4K coverage index alone is about 470 MB.
+
+_STATE = OrderedDict()
+_SIZE = 0   #Bytes held by _STATE
+
+MIX = np.uint64(0xff51afd7ed558ccd)
+PRIMES = np.array([0x9e3779b97f4a7c15, 0xc2b2ae3d27d4eb4f, 0x165667b19e3779f9,
+                   0x27d4eb2f165667c5, 0x94d049bb133111eb], dtype=np.uint64)
+
+def face_digests(mesh):
+    """Returns a 64 bit digest of the positions and uvs of every polygon (P,)"""
+    loop_start = raster.int_array(mesh.polygons, 'loop_start', len(mesh.polygons))
+    loop_total = raster.int_array(mesh.polygons, 'loop_total', len(mesh.polygons))
+    if not len(loop_start):
+        return np.empty(0, dtype=np.uint64)
+    co = raster.vertex_coords(mesh)[raster.loop_vertices(mesh)]
+    data = np.concatenate((co, raster.uv_coords(mesh)), axis=1)
+    bits = np.ascontiguousarray(data, dtype=np.float32).view(np.uint32).astype(np.uint64)
+
+    #Mix each loop into a 64 bit hash, its place in the polygon included so rotated loops count as changed.
+    h = (bits * PRIMES).sum(axis=1, dtype=np.uint64)
+    h ^= (np.arange(len(h)) - np.repeat(loop_start, loop_total)).astype(np.uint64)
+    h ^= h >> np.uint64(33)
+    h *= MIX
+    h ^= h >> np.uint64(33)
+    return np.add.reduceat(h, loop_start)
+
+def face_bounds(ob):
+    """Returns the world space bounding box of every polygon of ob (P, 6), lower corner then upper corner"""
+    mesh = ob.data
+    loop_start = raster.int_array(mesh.polygons, 'loop_start', len(mesh.polygons))
+    if not len(loop_start):
+        return np.empty((0, 6), dtype=np.float32)
+    matrix = np.array(ob.matrix_world, dtype=np.float32)
+    co = raster.vertex_coords(mesh) @ matrix[:3, :3].T + matrix[:3, 3]
+    co = co[raster.loop_vertices(mesh)]
+    return np.concatenate((np.minimum.reduceat(co, loop_start), np.maximum.reduceat(co, loop_start)), axis=1)
+
+def near_faces(bounds, boxes, reach, chunk=256):
+    """Returns a bool per box of bounds of boxes within reach of any of boxes"""
+    near = np.zeros(len(bounds), dtype=bool)
+    for i in range(0, len(boxes), chunk):
+        part = boxes[i:i + chunk, None]
+        near |= ((bounds[None, :, :3] <= part[:, :, 3:] + reach) &
+                 (bounds[None, :, 3:] >= part[:, :, :3] - reach)).all(axis=2).any(axis=0)
+    return near
+
+def state_bytes(state):
+    coverage = state['coverage']
+    size = coverage.pixels.nbytes + coverage.tris.nbytes + coverage.bary.nbytes + state['digests'].nbytes
+    for name in ('values', 'bounds'):
+        if state[name] is not None:
+            size += state[name].nbytes
+    return size
+
+def drop(key):
+    global _SIZE
+    state = _STATE.pop(key, None)
+    if state is not None:
+        _SIZE -= state_bytes(state)
+
+def forget(ob=None, map_type=None):
+    """Drops remembered bakes, of one object(and map type) or all"""
+    global _SIZE
+    if ob is None:
+        _STATE.clear()
+        _SIZE = 0
+        return
+    for key in [key for key in _STATE if key[0] == ob.name and map_type in (None, key[1])]:
+        drop(key)
+
+def remember(ob, map_type, image, coverage, digests=None, kind=None, values=None, settings=None, bounds=None):
+    """Stores what the bake of map_type for ob was made from. settings is anything else the bake depends on,
+    bounds the face_bounds of maps that reach past their faces"""
+    global _SIZE
+    if digests is None:
+        digests = face_digests(ob.data)
+    key = (ob.name, map_type)
+    drop(key)
+    state = _STATE[key] = {
+        'size': tuple(image.size),
+        'image': image.name,
+        'digests': digests,
+        'coverage': coverage,
+        'kind': kind,
+        'values': values,
+        'settings': repr(settings),
+        'bounds': bounds,
+    }
+    _SIZE += state_bytes(state)
+    #Least recently baked go first, the bake just remembered always stays.
+    while _SIZE > STATE_SIZE * 1024 * 1024 and len(_STATE) > 1:
+        drop(next(iter(_STATE)))
+
+@persistent
+def load_handler(dummy):
+    """Remembered bakes belong to the objects of the file they were made in"""
+    forget()
+
+def register_handlers():
+    if load_handler not in bpy.app.handlers.load_pre:
+        bpy.app.handlers.load_pre.append(load_handler)
+
+def unregister_handlers():
+    if load_handler in bpy.app.handlers.load_pre:
+        bpy.app.handlers.load_pre.remove(load_handler)
+    forget()
+
+####################################
+####    DIRTY REGION
+#
+
+def changed_faces(mesh, state, digests, kind, values):
+    """Returns a bool per polygon of faces whose pixels differ from the last bake. None if everything changed"""
+    if len(digests) != len(state['digests']):
+        return None
+    dirty = digests != state['digests']
+    if kind is None:
+        return dirty
+    old = state['values']
+    if kind != state['kind'] or old is None or old.shape != values.shape:
+        return None
+    changed = np.abs(values - old) > 1e-6
+    if kind == 'FACE':
+        return dirty | changed.reshape(len(changed), -1).any(axis=1)
+    #A vertex value change touches every face around the vertex.
+    loop_total = raster.int_array(mesh.polygons, 'loop_total', len(mesh.polygons))
+    loop_poly = np.repeat(np.arange(len(mesh.polygons)), loop_total)
+    touched = np.bincount(loop_poly, weights=changed[raster.loop_vertices(mesh)], minlength=len(dirty)) > 0
+    return dirty | touched
+
+def grow(mask, steps):
+    """Returns mask grown by steps pixels(or tiles) in every direction"""
+    mask = mask.copy()
+    for i in range(int(steps)):
+        grown = mask.copy()
+        grown[1:] |= mask[:-1]
+        grown[:-1] |= mask[1:]
+        grown[:, 1:] |= mask[:, :-1]
+        grown[:, :-1] |= mask[:, 1:]
+        mask = grown
+    return mask
+
+def tile_mask(pixels, width, height, margin):
+    """Returns a (height, width) mask of the tiles holding pixels, grown to include the margin around them"""
+    rows = (height + TILE - 1) // TILE
+    cols = (width + TILE - 1) // TILE
+    tiles = np.zeros(rows * cols, dtype=bool)
+    tiles[(pixels // width) // TILE * cols + (pixels % width) // TILE] = True
+    tiles = grow(tiles.reshape(rows, cols), (int(margin) + TILE - 1) // TILE)
+    return np.kron(tiles, np.ones((TILE, TILE), dtype=bool))[:height, :width]
+
+def dirty_region(ob, map_type, image, kind=None, values=None, margin=0, settings=None, bounds=None, reach=0.0):
+    """Returns the (height, width) mask of pixels to rewrite, the new coverage and face digests.
+    With bounds, faces within reach of a changed face are rewritten too.
+    The mask is None if there is no usable earlier bake, or settings changed, and everything has to be baked"""
+    mesh = ob.data
+    width, height = image.size
+    coverage = raster.get_coverage(mesh, width, height)
+    digests = face_digests(mesh)
+    state = _STATE.get((ob.name, map_type))
+    if state is None or state['size'] != (width, height) or state['image'] != image.name:
+        return None, coverage, digests
+    if state['settings'] != repr(settings):
+        return None, coverage, digests
+    _STATE.move_to_end((ob.name, map_type))
+
+    faces = changed_faces(mesh, state, digests, kind, values)
+    if faces is None:
+        return None, coverage, digests
+    if bounds is not None and faces.any():
+        if state['bounds'] is None or state['bounds'].shape != bounds.shape:
+            return None, coverage, digests
+        boxes = np.concatenate((state['bounds'][faces], bounds[faces]))
+        faces = faces | near_faces(bounds, boxes, reach)
+    old = state['coverage']
+    pixels = np.concatenate((
+        old.pixels[faces[old.tri_polys[old.tris]]],
+        coverage.pixels[faces[coverage.tri_polys[coverage.tris]]],
+    ))
+    if not len(pixels):
+        return np.zeros((height, width), dtype=bool), coverage, digests
+    return tile_mask(pixels, width, height, margin), coverage, digests
+
+####################################
+####    WRITING
+#
+
+def write_region(image, coverage, mask, values, margin=0):
+    """Rewrites the masked pixels of image. values are linear values/colors for the covered pixels in the mask"""
+    width, height = image.size
+    buf = px.read(image, 'region')
+    rows = px.pixel_rows(buf)
+    region = mask.ravel()
+    rows[region] = (0.0, 0.0, 0.0, 1.0)
+    inside = region[coverage.pixels]
+    rows[coverage.pixels[inside], :3] = raster.encode_values(image, values)
+
+    if margin:
+        #Dilate a crop around the region, the covered pixels around it feed the margin.
+        rows = np.flatnonzero(mask.any(axis=1))
+        cols = np.flatnonzero(mask.any(axis=0))
+        y0, y1 = max(rows[0] - int(margin), 0), min(rows[-1] + int(margin) + 1, height)
+        x0, x1 = max(cols[0] - int(margin), 0), min(cols[-1] + int(margin) + 1, width)
+        crop = buf[y0:y1, x0:x1].copy()
+        covered = coverage.mask()[y0:y1, x0:x1]
+        crop[~covered] = (0.0, 0.0, 0.0, 1.0)
+        raster.dilate(crop, covered, margin)
+        crop_mask = mask[y0:y1, x0:x1]
+        buf[y0:y1, x0:x1][crop_mask] = crop[crop_mask]
+    px.write(image, buf)
+    return image
+
+def bake_analytic(ob, map_type, image, kind, values, margin=0, settings=None):
+    """Bakes an analytic map from map_values, rewriting only what changed since the last bake. Returns image"""
+    with gp_profile.span("Dirty region", ob):
+        mask, coverage, digests = dirty_region(ob, map_type, image, kind, values, margin, settings)
+    loop_vert = raster.loop_vertices(ob.data)
+    with gp_profile.span(map_type, ob):
+        if mask is None:
+            raster.write_coverage(image, coverage, maps.pixel_values(coverage, kind, values, loop_vert), margin)
+        elif mask.any():
+            sub = coverage.subset(mask.ravel()[coverage.pixels])
+            write_region(image, coverage, mask, maps.pixel_values(sub, kind, values, loop_vert), margin)
+    remember(ob, map_type, image, coverage, digests, kind, values, settings)
+    return image
+
+####################################
+####    CYCLES
+#
+
+def faces_in(coverage, mask, poly_count, margin=0):
+    """Returns a bool per polygon of faces with pixels in mask grown by margin. Their bake reaches the mask"""
+    near = grow(mask, margin).ravel()[coverage.pixels]
+    faces = np.zeros(poly_count, dtype=bool)
+    faces[coverage.tri_polys[coverage.tris[near]]] = True
+    return faces
+
+@contextmanager
+def isolate_faces(mesh, faces):
+    """Moves the uvs of every face not in faces off the image while inside the block"""
+    uv_data = mesh.uv_layers.active.data
+    original = raster.uv_coords(mesh)
+    loop_total = raster.int_array(mesh.polygons, 'loop_total', len(mesh.polygons))
+    moved = original.copy()
+    moved[~np.repeat(faces, loop_total)] = OFF_IMAGE
+    uv_data.foreach_set('uv', moved.ravel())
+    try:
+        yield
+    finally:
+        uv_data.foreach_set('uv', original.ravel())
+        mesh.update()
+
+def copy_region(source, target, mask):
+    """Copies the masked pixels of source into target"""
+    buf = px.read(target, 'region')
+    buf[mask] = px.read(source, 'region_source')[mask]
+    px.write(target, buf)
+    return target
@@ -0,0 +1,267 @@
+import bpy
+import colorsys
+import numpy as np
+import gp_raster as raster
+import gp_pixels as px
+import gp_profile
+
+#INFO:
+#       Analytic map bakes. Each map is computed straight from mesh data with NumPy and written
+#       into the image through the uv coverage index in gp_raster. No material, no Cycles bake.
+
+ANALYTIC_MAPS = {'POS', 'CURVE', 'ID'}
+
+AXES = {
+    'X': (1.0, 0.0, 0.0),
+    'Y': (0.0, 1.0, 0.0),
+    'Z': (0.0, 0.0, 1.0),
+    '-X': (-1.0, 0.0, 0.0),
+    '-Y': (0.0, -1.0, 0.0),
+    '-Z': (0.0, 0.0, -1.0),
+}
+
+def axis_direction(axis, custom=(0.0, 0.0, 1.0)):
+    """Returns the direction vector for an axis name. 'CUSTOM' uses the custom vector"""
+    if axis == 'CUSTOM':
+        return tuple(custom)
+    return AXES[axis]
+
+####################################
+####    POSITION
+#
+
+def position_values(mesh, direction):
+    """Returns the vertex positions projected on direction, normalized to 0-1 over the mesh"""
+    co = raster.vertex_coords(mesh)
+    direction = np.asarray(direction, dtype=np.float32)
+    length = np.linalg.norm(direction)
+    if length == 0.0:
+        direction = np.array(AXES['Z'], dtype=np.float32)
+    else:
+        direction = direction / length
+
+    height = co @ direction
+    if len(height) == 0:
+        return height
+    low = height.min()
+    span = height.max() - low
+    if span == 0.0:
+        return np.zeros_like(height)
+    return (height - low) / span
+
+def position_map(ob, image, direction=AXES['Z'], margin=0):
+    """Returns image with a position gradient along direction, in object space"""
+    return analytic_maps(ob, {'POS': image}, direction=direction, margin=margin)['POS']
+
+####################################
+####    CURVATURE
+#
+
+def edge_faces(mesh):
+    """Returns the edges with exactly two faces (M,) and the two polygon indices of each (M, 2)"""
+    loop_total = raster.int_array(mesh.polygons, 'loop_total', len(mesh.polygons))
+    loop_edge = raster.int_array(mesh.loops, 'edge_index', len(mesh.loops))
+    loop_poly = np.repeat(np.arange(len(mesh.polygons)), loop_total)
+
+    order = np.argsort(loop_edge, kind='stable')
+    counts = np.bincount(loop_edge, minlength=len(mesh.edges))
+    starts = np.cumsum(counts) - counts
+    manifold = np.flatnonzero(counts == 2)
+    first = order[starts[manifold]]
+    second = order[starts[manifold] + 1]
+    return manifold, np.stack((loop_poly[first], loop_poly[second]), axis=1)
+
+def curvature_values(mesh, radius=0):
+    """Returns per vertex convexity in 0-1 from the dihedral angles of its edges. 0.5 is flat.
+    radius is the number of edge rings the result is smoothed over"""
+    normals = np.empty(len(mesh.polygons) * 3, dtype=np.float32)
+    centers = np.empty(len(mesh.polygons) * 3, dtype=np.float32)
+    mesh.polygons.foreach_get('normal', normals)
+    mesh.polygons.foreach_get('center', centers)
+    normals = normals.reshape(-1, 3)
+    centers = centers.reshape(-1, 3)
+    edge_verts = raster.int_array(mesh.edges, 'vertices', len(mesh.edges) * 2)
+    edge_verts = edge_verts.reshape(-1, 2)
+
+    edges, faces = edge_faces(mesh)
+    n1 = normals[faces[:, 0]]
+    n2 = normals[faces[:, 1]]
+    angle = np.arccos(np.clip(np.einsum('ij,ij->i', n1, n2), -1.0, 1.0))
+    #The neighbour's center lies behind the face normal on a convex edge.
+    offset = centers[faces[:, 1]] - centers[faces[:, 0]]
+    convex = np.einsum('ij,ij->i', offset, n1) <= 0.0
+    angle = np.where(convex, angle, -angle)
+
+    vert_count = len(mesh.vertices)
+    ends = edge_verts[edges].ravel()
+    total = np.bincount(ends, weights=np.repeat(angle, 2), minlength=vert_count)
+    degree = np.bincount(edge_verts.ravel(), minlength=vert_count).astype(np.float64)
+    values = total / np.maximum(degree, 1.0)
+
+    for i in range(int(radius)):
+        neighbours = np.bincount(edge_verts[:, 0], weights=values[edge_verts[:, 1]], minlength=vert_count)
+        neighbours += np.bincount(edge_verts[:, 1], weights=values[edge_verts[:, 0]], minlength=vert_count)
+        values = (values + neighbours) / (1.0 + degree)
+
+    scale = np.abs(values).max() if len(values) else 0.0
+    if scale == 0.0:
+        return np.full(vert_count, 0.5, dtype=np.float32)
+    return (0.5 + 0.5 * values / scale).astype(np.float32)
+
+def curvature_map(ob, image, radius=0, margin=0, scene=None):
+    """Returns image with a curvature map. Uses the modifier evaluated mesh if a scene is given"""
+    if scene is None:
+        mesh = ob.data
+    else:
+        mesh = ob.to_mesh(scene, True, 'PREVIEW')
+    try:
+        width, height = image.size
+        coverage = raster.get_coverage(mesh, width, height, cache=mesh is ob.data)
+        values = vertex_pixels(coverage, curvature_values(mesh, radius), raster.loop_vertices(mesh))
+        return raster.write_coverage(image, coverage, values, margin)
+    finally:
+        if mesh is not ob.data:
+            bpy.data.meshes.remove(mesh)
+
+####################################
+####    ID
+#
+
+GOLDEN_RATIO = 0.618033988749895
+
+def id_palette(count):
+    """Returns count well spaced colors (count, 3). The same count always gives the same colors"""
+    hues = (np.arange(count) * GOLDEN_RATIO) % 1.0
+    return np.array([colorsys.hsv_to_rgb(h, 1.0, 1.0) for h in hues], dtype=np.float32).reshape(-1, 3)
+
+def face_groups(mesh, group_count):
+    """Returns the vertex group with the most weight on each polygon (P,), -1 where no group is assigned"""
+    poly_count = len(mesh.polygons)
+    result = np.full(poly_count, -1, dtype=np.int64)
+    #Group weights aren't exposed to foreach_get, so they are gathered in one pass.
+    entries = [(v.index, g.group, g.weight) for v in mesh.vertices for g in v.groups]
+    if not entries or group_count == 0:
+        return result
+    entries = np.array(entries, dtype=np.float64)
+    order = np.argsort(entries[:, 0], kind='stable')
+    ent_vert = entries[order, 0].astype(np.int64)
+    ent_group = entries[order, 1].astype(np.int64)
+    ent_weight = entries[order, 2]
+
+    loop_total = raster.int_array(mesh.polygons, 'loop_total', poly_count)
+    loop_poly = np.repeat(np.arange(poly_count), loop_total)
+    loop_vert = raster.loop_vertices(mesh)
+
+    #Expand every loop to the group entries of its vertex.
+    counts = np.bincount(ent_vert, minlength=len(mesh.vertices))
+    starts = np.cumsum(counts) - counts
+    loop_count = counts[loop_vert]
+    loop_idx = np.repeat(np.arange(len(loop_vert)), loop_count)
+    offset = np.arange(len(loop_idx)) - np.repeat(np.cumsum(loop_count) - loop_count, loop_count)
+    ent = starts[loop_vert[loop_idx]] + offset
+
+    key = loop_poly[loop_idx] * group_count + ent_group[ent]
+    keys, inverse = np.unique(key, return_inverse=True)
+    sums = np.bincount(inverse, weights=ent_weight[ent])
+    polys = keys // group_count
+    groups = keys % group_count
+
+    #Heaviest group first within each polygon, lowest group index on ties.
+    order = np.lexsort((groups, -sums, polys))
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = polys[order][1:] != polys[order][:-1]
+    result[polys[order][first]] = groups[order][first]
+    return result
+
+def id_colors(ob, mesh):
+    """Returns the ID color of every polygon (P, 3)"""
+    group_count = len(ob.vertex_groups)
+    groups = face_groups(mesh, group_count)
+    face_colors = np.zeros((len(groups), 3), dtype=np.float32)
+    assigned = groups >= 0
+    face_colors[assigned] = id_palette(group_count)[groups[assigned]]
+    return face_colors
+
+def id_map(ob, image, margin=0):
+    """Returns image with a flat color per vertex group. Faces belong to the group with the most weight on them"""
+    return analytic_maps(ob, {'ID': image}, margin=margin)['ID']
+
+####################################
+####    MULTI MAP
+#
+
+def vertex_pixels(coverage, values, loop_vert):
+    """Returns per vertex values interpolated to every covered pixel"""
+    return coverage.interpolate(values[loop_vert][coverage.tri_loops])
+
+def face_pixels(coverage, values):
+    """Returns per polygon values at every covered pixel"""
+    return values[coverage.tri_polys[coverage.tris]]
+
+def map_values(ob, mesh, map_type, direction=AXES['Z'], radius=0):
+    """Returns ('VERT', per vertex values) or ('FACE', per polygon values) of an analytic map"""
+    if map_type == 'POS':
+        return 'VERT', position_values(mesh, direction)
+    elif map_type == 'CURVE':
+        return 'VERT', curvature_values(mesh, radius)
+    elif map_type == 'ID':
+        return 'FACE', id_colors(ob, mesh)
+    raise ValueError("Not an analytic map type: %s" % map_type)
+
+def pixel_values(coverage, kind, values, loop_vert):
+    """Returns the values from map_values at every covered pixel"""
+    if kind == 'VERT':
+        return vertex_pixels(coverage, values, loop_vert)
+    return face_pixels(coverage, values)
+
+def analytic_maps(ob, images, direction=AXES['Z'], radius=0, margin=0, scene=None):
+    """Bakes several analytic maps in one pass over the mesh. images maps a map type to its image. Returns images
+    Mesh buffers and coverage indices are read once and shared by every map of the same size"""
+    mesh = ob.data
+    loop_vert = raster.loop_vertices(mesh)
+    coverages = {}
+    for map_type, image in images.items():
+        if map_type == 'CURVE' and scene is not None:
+            #Runs on the evaluated mesh, which has its own topology.
+            with gp_profile.span(map_type):
+                curvature_map(ob, image, radius, margin, scene)
+            continue
+
+        size = tuple(image.size)
+        if size not in coverages:
+            with gp_profile.span("UV coverage"):
+                coverages[size] = raster.get_coverage(mesh, size[0], size[1])
+        coverage = coverages[size]
+
+        with gp_profile.span(map_type):
+            kind, values = map_values(ob, mesh, map_type, direction, radius)
+            raster.write_coverage(image, coverage, pixel_values(coverage, kind, values, loop_vert), margin)
+    return images
+
+def atlas_maps(objects, images, direction=AXES['Z'], radius=0, margin=0):
+    """Bakes analytic maps of several objects sharing one uv atlas into the same images. Returns images
+    Each object writes only the pixels its own islands cover, the margin is dilated once over all of them"""
+    buffers = {}
+    covered = {}
+    for map_type, image in images.items():
+        width, height = image.size
+        buffers[map_type] = px.buffer(width, height, ''.join(['atlas_', map_type]))
+        px.pixel_rows(buffers[map_type])[:] = (0.0, 0.0, 0.0, 1.0)
+        covered[map_type] = np.zeros(width * height, dtype=bool)
+
+    for ob in objects:
+        mesh = ob.data
+        loop_vert = raster.loop_vertices(mesh)
+        for map_type, image in images.items():
+            coverage = raster.get_coverage(mesh, image.size[0], image.size[1])
+            kind, values = map_values(ob, mesh, map_type, direction, radius)
+            rows = px.pixel_rows(buffers[map_type])
+            rows[coverage.pixels, :3] = raster.encode_values(image, pixel_values(coverage, kind, values, loop_vert))
+            covered[map_type][coverage.pixels] = True
+
+    for map_type, image in images.items():
+        width, height = image.size
+        if margin:
+            raster.dilate(buffers[map_type], covered[map_type].reshape(height, width), margin)
+        px.write(image, buffers[map_type])
+    return images
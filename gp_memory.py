@@ -0,0 +1,96 @@
+import bpy
+import time
+import gp_utils as gp
+import gp_pack
+
+#INFO:
+#       Memory budget of the images the add-ons make. Images tagged with an 'ID'(Gradient Painter) or a
+#       'GP_owner'(GameTexTools) are counted in bytes. Both hold the object ID, so renaming an object keeps its
+#       images. Over budget, the least recently used images of objects that are gone or hidden are unloaded:
+#       packed and their buffers freed. Nothing is deleted, Blender reloads a freed image from its packed PNG
+#       the next time it is needed.
+
+DEFAULT_BUDGET = 1024   #MB
+OWNER = gp.BAKE_OWNER   #ID of the object a GameTexTools image was baked for. Empty for shared images.
+MAP = gp.BAKE_MAP       #Map type a GameTexTools image holds.
+
+_USED = {}  #Image name -> time last baked or used
+
+def touch(image):
+    """Marks image as just used"""
+    _USED[image.name] = time.time()
+
+def image_bytes(image):
+    """Returns the bytes held by the image's buffer, 0 if it isn't loaded"""
+    if not image.has_data:
+        return 0
+    width, height = image.size
+    return width * height * image.channels * (4 if image.is_float else 1)
+
+def owner_key(ob):
+    """Returns the GP_owner tag of images baked for ob, giving ob an ID if it has none"""
+    if ob is None:
+        return ""
+    return gp.check_id(bpy.context, ob)['ID']
+
+def find_image(ob, map_type):
+    """Returns the GameTexTools image baked for ob with map_type, None if there is none or ob has no ID yet"""
+    return gp.find_item('BAKE', ob.get('ID') if ob is not None else "", map_type)
+
+def owned_images():
+    return [image for image in bpy.data.images if image.get('ID') is not None or OWNER in image]
+
+def owner_state(image, objects_by_id, scene):
+    """Returns 'GONE' if the image's object no longer exists, 'HIDDEN' if it is hidden and 'SHOWN' otherwise"""
+    owner = image[OWNER] if OWNER in image else image['ID']
+    if owner == "":
+        return 'SHOWN'
+    ob = objects_by_id.get(owner)
+    if ob is None:
+        return 'GONE'
+    if not ob.is_visible(scene):
+        return 'HIDDEN'
+    return 'SHOWN'
+
+def usage():
+    """Returns the bytes held by add-on images"""
+    return sum(image_bytes(image) for image in owned_images())
+
+def evict(image):
+    """Unloads image: packs it if it has nowhere to reload from and frees its buffer. Returns the bytes freed"""
+    freed = image_bytes(image)
+    if image.packed_file is None and not image.filepath:
+        #Keep the pixels as a packed PNG, so the buffer can be reloaded.
+        gp_pack.defer(image)
+    #Queued packs hold the latest pixels, they have to land before the buffer goes.
+    gp_pack.flush()
+    image.buffers_free()
+    return freed
+
+def enforce(scene, budget=None):
+    """Unloads images of gone or hidden objects, least recently used first, until add-on images fit the budget.
+    budget is in MB, the scene's image_budget if not given. Returns the bytes freed"""
+    if budget is None:
+        budget = getattr(scene, 'image_budget', DEFAULT_BUDGET)
+    images = owned_images()
+    total = sum(image_bytes(image) for image in images)
+    limit = budget * 1024 * 1024
+    if total <= limit:
+        return 0
+
+    objects_by_id = {ob['ID']: ob for ob in bpy.data.objects if ob.get('ID') is not None}
+    candidates = []
+    for image in images:
+        if not image_bytes(image):
+            continue
+        state = owner_state(image, objects_by_id, scene)
+        if state != 'SHOWN':
+            candidates.append((_USED.get(image.name, 0.0), image.name, image))
+    candidates.sort(key=lambda c: c[:2])
+
+    freed = 0
+    for used, name, image in candidates:
+        if total - freed <= limit:
+            break
+        freed += evict(image)
+    return freed
@@ -0,0 +1,147 @@
+import bpy
+import struct
+import zlib
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from bpy.app.handlers import persistent
+import gp_raster as raster
+import gp_pixels as px
+import gp_profile
+
+#INFO:
+#       Deferred packing of bake results. image.pack(as_png=True) encodes on the main thread and blocks the UI
+#       and the next bake. Instead the pixels are snapshot right after the bake and encoded to PNG on worker
+#       threads. Finished encodes are packed whenever the add-on next defers or flushes, and everything still
+#       pending is packed before the file is saved.
+#       Without foreach_get(Blender before 2.83) the snapshot alone costs more than Blender's own packing, so
+#       images are then queued as they are and packed with pack(as_png=True) when flushed or saved.
+
+WORKERS = 2
+COMPRESSION = 1     #zlib level. Blender's default PNG compression is about the same.
+
+_PENDING = {}       #Image name -> (image, future). No future for images packed by Blender at flush
+_EXECUTOR = None
+
+def executor():
+    global _EXECUTOR
+    if _EXECUTOR is None:
+        _EXECUTOR = ThreadPoolExecutor(max_workers=WORKERS)
+    return _EXECUTOR
+
+####################################
+####    ENCODING
+#
+
+def png_chunk(tag, data):
+    return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data) & 0xffffffff)
+
+def encode_png(buf, srgb_encode):
+    """Returns buf (H, W, 4), bottom row first like Blender, as the bytes of an 8 bit RGBA PNG.
+    Runs on a worker thread, so it must not touch bpy"""
+    if srgb_encode:
+        buf = buf.copy()
+        buf[:, :, :3] = raster.linear_to_srgb(buf[:, :, :3])
+    height, width = buf.shape[:2]
+    rows = np.empty((height, width * 4 + 1), dtype=np.uint8)
+    rows[:, 0] = 0      #No filter.
+    rows[:, 1:] = np.rint(np.clip(buf[::-1], 0.0, 1.0) * 255.0).reshape(height, -1)
+    header = struct.pack(">IIBBBBB", width, height, 8, 6, 0, 0, 0)
+    return b''.join([
+        b'\x89PNG\r\n\x1a\n',
+        png_chunk(b'IHDR', header),
+        png_chunk(b'IDAT', zlib.compress(rows.tobytes(), COMPRESSION)),
+        png_chunk(b'IEND', b''),
+    ])
+
+def encode_job(name, buf, srgb_encode):
+    with gp_profile.span("PNG encode", name):
+        return encode_png(buf, srgb_encode)
+
+def pack_data(image, data):
+    """Packs encoded PNG bytes into image, the way pack(as_png=True) would"""
+    try:
+        image.filepath_raw = ''.join(['//', image.name, '.png'])
+        image.file_format = 'PNG'
+        image.pack(data=data, data_len=len(data))
+        image.source = 'FILE'
+    except (TypeError, RuntimeError):
+        image.pack(as_png=True)
+
+####################################
+####    QUEUE
+#
+
+def defer(image):
+    """Queues image for packing. Its pixels are snapshot now, later changes need another defer"""
+    if not px.is_fast(image):
+        _PENDING[image.name] = (image, None)
+        return
+    #Float images are saved to 8 bit PNG display encoded, the same as Blender does.
+    with gp_profile.span("Pack snapshot", image.name):
+        buf = px.read(image)
+    future = executor().submit(encode_job, image.name, buf, image.is_float)
+    _PENDING[image.name] = (image, future)
+    flush(wait=False)
+
+def flush(wait=True):
+    """Packs finished encodes. With wait, blocks until everything pending is packed"""
+    for name, (image, future) in list(_PENDING.items()):
+        if future is None:
+            if not wait:
+                continue
+            del _PENDING[name]
+            try:
+                with gp_profile.span("Pack", name):
+                    image.pack(as_png=True)
+            except ReferenceError:
+                pass
+            continue
+        if not future.done() and not wait:
+            continue
+        del _PENDING[name]
+        try:
+            data = future.result()
+        except Exception as error:
+            print("Packing", name, "failed:", error)
+            continue
+        try:
+            with gp_profile.span("Pack", name):
+                pack_data(image, data)
+        except ReferenceError:
+            pass    #Removed since it was queued.
+
+def discard():
+    """Forgets everything pending, the images belong to a file that is being closed"""
+    for image, future in _PENDING.values():
+        if future is not None:
+            future.cancel()
+    _PENDING.clear()
+
+@persistent
+def save_handler(scene):
+    flush()
+
+@persistent
+def load_handler(scene):
+    discard()
+
+_HANDLER_USERS = 0  #Add-ons that registered the handlers. They stay until the last one unregisters.
+
+def register_handlers():
+    global _HANDLER_USERS
+    _HANDLER_USERS += 1
+    if save_handler not in bpy.app.handlers.save_pre:
+        bpy.app.handlers.save_pre.append(save_handler)
+    if load_handler not in bpy.app.handlers.load_pre:
+        bpy.app.handlers.load_pre.append(load_handler)
+
+def unregister_handlers():
+    global _HANDLER_USERS
+    flush()
+    _HANDLER_USERS = max(_HANDLER_USERS - 1, 0)
+    if _HANDLER_USERS:
+        return
+    if save_handler in bpy.app.handlers.save_pre:
+        bpy.app.handlers.save_pre.remove(save_handler)
+    if load_handler in bpy.app.handlers.load_pre:
+        bpy.app.handlers.load_pre.remove(load_handler)
@@ -0,0 +1,84 @@
+import numpy as np
+from collections import OrderedDict
+
+#INFO:
+#       Pixel buffers. Images are moved in and out of float32 arrays (height, width, 4) with foreach_get/set
+#       where Blender has it for pixels(2.83 and up). Older versions only have the image.pixels[:] sequence
+#       path, a Python float per channel, so callers check is_fast() and skip reads that are only there to
+#       save time, leaving copies and packing to Blender's C side. Named slots keep one preallocated buffer per
+#       resolution, so repeated bakes don't reallocate. A slot's buffer is overwritten by the next read into
+#       the same slot, so anything kept around(caches, worker threads) must read without a slot.
+#       Channels are views into the buffer, ramps, dilation and resampling work on them without copies.
+
+POOL_SIZE = 512     #MB kept in pooled buffers.
+
+_POOL = OrderedDict()   #(width, height, slot) -> buffer
+_POOL_BYTES = 0
+_FAST = None            #foreach_get/set on image pixels, found out on first use
+
+def is_fast(image):
+    """Returns True if image pixels can be moved without the sequence path"""
+    global _FAST
+    if _FAST is None:
+        _FAST = hasattr(image.pixels, 'foreach_get')
+    return _FAST
+
+def buffer(width, height, slot=None):
+    """Returns a float32 buffer (height, width, 4). Pooled by slot, contents are left over from earlier use"""
+    global _POOL_BYTES
+    if slot is None:
+        return np.empty((height, width, 4), dtype=np.float32)
+    key = (width, height, slot)
+    buf = _POOL.get(key)
+    if buf is None:
+        buf = np.empty((height, width, 4), dtype=np.float32)
+        _POOL[key] = buf
+        _POOL_BYTES += buf.nbytes
+        while _POOL_BYTES > POOL_SIZE * 1024 * 1024 and len(_POOL) > 1:
+            old_key, old = _POOL.popitem(last=False)
+            _POOL_BYTES -= old.nbytes
+    else:
+        _POOL.move_to_end(key)
+    return buf
+
+def clear():
+    """Frees every pooled buffer"""
+    global _POOL_BYTES
+    _POOL.clear()
+    _POOL_BYTES = 0
+
+def read(image, slot=None):
+    """Returns the pixels of image as a buffer (height, width, 4), pooled by slot"""
+    width, height = image.size
+    buf = buffer(width, height, slot)
+    flat = buf.reshape(-1)
+    if is_fast(image):
+        image.pixels.foreach_get(flat)
+    else:
+        flat[:] = image.pixels[:]
+    return buf
+
+def write(image, buf):
+    """Writes a buffer (height, width, 4) into image"""
+    flat = np.ascontiguousarray(buf, dtype=np.float32).reshape(-1)
+    if is_fast(image):
+        image.pixels.foreach_set(flat)
+    else:
+        image.pixels[:] = flat.tolist()
+    image.update()
+    return image
+
+def channel(buf, index):
+    """Returns a (height, width) view of one channel of buf"""
+    return buf[:, :, index]
+
+def rgb(buf):
+    """Returns a (height, width, 3) view of the color channels of buf"""
+    return buf[:, :, :3]
+
+def alpha(buf):
+    return buf[:, :, 3]
+
+def pixel_rows(buf):
+    """Returns a (height * width, 4) view of buf, one row per pixel"""
+    return buf.reshape(-1, 4)
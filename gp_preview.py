@@ -0,0 +1,108 @@
+import bpy
+import time
+import numpy as np
+from bpy.app.handlers import persistent
+import gp_utils as gp
+import gp_raster as raster
+import gp_ramp
+
+#INFO:
+#       Live view oriented preview. The vertices of every painted object are projected onto the view direction
+#       of the 3d view, mapped through the object's ramp and written into a vertex color layer. Runs from
+#       scene_update_post when the view has turned. Objects are updated in turns within a time budget per
+#       update, whatever is left waits for the next one, so orbiting stays smooth with many objects.
+
+PREVIEW_LAYER = 'GP_Preview'
+ANGLE_EPSILON = 1e-4    #Smaller turns of the view are ignored.
+DEFAULT_BUDGET = 8      #Milliseconds per update.
+
+_STATE = {'direction': None, 'queue': [], 'budget': DEFAULT_BUDGET}
+
+def view_direction():
+    """Returns the direction the first 3d view looks in, None if there is no 3d view"""
+    for window in bpy.context.window_manager.windows:
+        for area in window.screen.areas:
+            if area.type == 'VIEW_3D':
+                rotation = area.spaces.active.region_3d.view_rotation.to_matrix()
+                return -np.array(rotation.col[2], dtype=np.float64)
+    return None
+
+def ramp_node(mat):
+    """Returns the ramp node of a painted material, None if it has none"""
+    if mat is None or not mat.use_nodes or mat.get('ID') is None:
+        return None
+    for node in mat.node_tree.nodes:
+        if node.type == 'VALTORGB':
+            return node
+    return None
+
+def painted_objects(scene):
+    """Returns the visible mesh objects with a gradient material"""
+    return [ob for ob in scene.objects
+            if ob.type == 'MESH' and ob.is_visible(scene) and ramp_node(ob.active_material) is not None]
+
+####################################
+####    COLORS
+#
+
+def view_values(ob, direction):
+    """Returns the depth of every vertex along direction, in world space, normalized to 0-1 over the object"""
+    matrix = np.array(ob.matrix_world, dtype=np.float64)
+    #Projecting onto the direction in world space is the same as onto its transform into object space.
+    depth = raster.vertex_coords(ob.data) @ (matrix[:3, :3].T @ direction) + matrix[:3, 3] @ direction
+    if not len(depth):
+        return depth
+    low, high = depth.min(), depth.max()
+    if high - low < 1e-12:
+        return np.zeros_like(depth)
+    return (depth - low) / (high - low)
+
+def update_object(ob, direction):
+    """Writes the view gradient of ob through its ramp into the preview vertex color layer"""
+    lut = gp_ramp.compile_ramp(ramp_node(ob.active_material).color_ramp)
+    colors = gp_ramp.apply_lut(lut, view_values(ob, direction))
+    gp.write_vertex_colors(ob.data, PREVIEW_LAYER, colors[raster.loop_vertices(ob.data)])
+
+def update(scene, direction):
+    """Updates queued objects until the time budget runs out. Returns the number of objects updated"""
+    start = time.perf_counter()
+    budget = _STATE['budget'] / 1000.0
+    queue = _STATE['queue']
+    done = 0
+    while queue and (done == 0 or time.perf_counter() - start < budget):
+        ob = scene.objects.get(queue.pop(0))
+        if ob is not None and ramp_node(ob.active_material) is not None:
+            update_object(ob, direction)
+            done += 1
+    return done
+
+####################################
+####    HANDLER
+#
+
+@persistent
+def preview_handler(scene):
+    direction = view_direction()
+    if direction is None:
+        return
+    last = _STATE['direction']
+    if last is None or np.abs(direction - last).max() > ANGLE_EPSILON:
+        #The view turned, everything needs redoing. Objects still queued from the last turn go first.
+        _STATE['direction'] = direction
+        names = [ob.name for ob in painted_objects(scene)]
+        queue = _STATE['queue']
+        _STATE['queue'] = queue + [name for name in names if name not in queue]
+    if _STATE['queue']:
+        update(scene, _STATE['direction'])
+
+def start(budget=DEFAULT_BUDGET):
+    """Turns the live preview on, updating within budget milliseconds per scene update"""
+    _STATE['budget'] = budget
+    _STATE['direction'] = None
+    if preview_handler not in bpy.app.handlers.scene_update_post:
+        bpy.app.handlers.scene_update_post.append(preview_handler)
+
+def stop():
+    _STATE['queue'] = []
+    if preview_handler in bpy.app.handlers.scene_update_post:
+        bpy.app.handlers.scene_update_post.remove(preview_handler)
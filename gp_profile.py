@@ -0,0 +1,93 @@
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+#INFO:
+#       Bake profiling. Bake stages are wrapped in named spans, tagged with the object they work on. Nested
+#       spans inherit the object of the span around them. The spans of the last bake are summed per object
+#       for the BakeMenu panel and can be exported as Chrome trace events, to open in chrome://tracing.
+#       Off by default, a disabled span costs one flag check.
+
+SHARED = "(shared)"     #Object name of spans that work on several objects at once.
+
+ENABLED = False
+_SPANS = []
+_LOCAL = threading.local()
+_LOCK = threading.Lock()
+_ORIGIN = time.perf_counter()
+
+def enable(enabled=True):
+    global ENABLED
+    ENABLED = enabled
+
+def begin():
+    """Starts a new profile, dropping the spans of the last one"""
+    global _ORIGIN
+    with _LOCK:
+        del _SPANS[:]
+        _ORIGIN = time.perf_counter()
+
+@contextmanager
+def span(name, ob=None):
+    """Times the block as a stage called name. ob is the object(or its name) the stage works on"""
+    if not ENABLED:
+        yield
+        return
+    stack = getattr(_LOCAL, 'stack', None)
+    if stack is None:
+        stack = _LOCAL.stack = []
+    if ob is None:
+        ob = stack[-1] if stack else SHARED
+    elif not isinstance(ob, str):
+        ob = ob.name
+    stack.append(ob)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        end = time.perf_counter()
+        stack.pop()
+        with _LOCK:
+            _SPANS.append({
+                'name': name,
+                'object': ob,
+                'start': start - _ORIGIN,
+                'duration': end - start,
+                'depth': len(stack),
+                'thread': threading.get_ident(),
+            })
+
+def breakdown():
+    """Returns an OrderedDict of object -> OrderedDict of stage -> seconds, and the total seconds per object.
+    Nested stages are counted in their own row as well as in the stage around them"""
+    with _LOCK:
+        spans = sorted(_SPANS, key=lambda s: s['start'])
+    stages = OrderedDict()
+    totals = OrderedDict()
+    for s in spans:
+        rows = stages.setdefault(s['object'], OrderedDict())
+        rows[s['name']] = rows.get(s['name'], 0.0) + s['duration']
+        if s['depth'] == 0:
+            totals[s['object']] = totals.get(s['object'], 0.0) + s['duration']
+    return stages, totals
+
+def export_chrome(filepath):
+    """Writes the spans of the last profile as Chrome trace events. Returns the number of events"""
+    pid = os.getpid()
+    with _LOCK:
+        events = [{
+            'name': s['name'],
+            'cat': 'bake',
+            'ph': 'X',
+            'ts': s['start'] * 1e6,
+            'dur': s['duration'] * 1e6,
+            'pid': pid,
+            'tid': s['thread'],
+            'args': {'object': s['object']},
+        } for s in _SPANS]
+    with open(filepath, 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+    return len(events)
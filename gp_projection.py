@@ -0,0 +1,204 @@
+import bpy
+import hashlib
+import numpy as np
+from collections import OrderedDict
+from bpy.props import EnumProperty
+import gp_raster as raster
+import gp_profile
+
+#INFO:
+#       UV projection of meshes that have no uv layout. Generated layouts are cached by a hash of the mesh's
+#       topology and vertex positions, so instances and duplicates of a mesh reuse the first one's layout
+#       instead of being unwrapped again. Linked duplicates share the mesh and are projected once.
+#       Two modes:
+#           SMART:  Blender's smart uv project, good islands but slow on dense meshes.
+#           BOX:    cube projection computed with NumPy. Every face is projected along the axis its normal
+#                   is closest to and the six sides are laid out side by side. Islands overlap on concave
+#                   shapes, which doesn't matter for gradient only textures.
+
+MODE_ITEMS = [('SMART', "Smart", "Smart uv project, slow on dense meshes"),
+              ('BOX', "Box", "Fast cube projection, for gradient only textures")]
+
+CACHE_SIZE = 32     #Number of layouts kept around.
+PADDING = 0.02      #Space kept around every side of a box projection, as a fraction of its cell.
+
+#Projection of every box side, +X -X +Y -Y +Z -Z: axis and sign of u, axis and sign of v.
+#Negative sides are flipped so no side comes out mirrored.
+BOX_U = np.array([(1, 1), (1, -1), (0, -1), (0, 1), (0, 1), (0, 1)])
+BOX_V = np.array([(2, 1), (2, 1), (2, 1), (2, 1), (1, 1), (1, -1)])
+
+_CACHE = OrderedDict()
+_PROP_USERS = 0     #Add-ons that registered projection_mode. It stays until the last one unregisters.
+
+def register_props():
+    """Adds projection_mode to the scene. Both add-ons call it, the setting is shared"""
+    global _PROP_USERS
+    _PROP_USERS += 1
+    if not hasattr(bpy.types.Scene, 'projection_mode'):
+        bpy.types.Scene.projection_mode = EnumProperty(
+            name="UV Projection",
+            description="How objects without a uv map are unwrapped before baking",
+            default='SMART',
+            items=MODE_ITEMS,
+        )
+
+def unregister_props():
+    global _PROP_USERS
+    _PROP_USERS = max(_PROP_USERS - 1, 0)
+    if not _PROP_USERS and hasattr(bpy.types.Scene, 'projection_mode'):
+        del bpy.types.Scene.projection_mode
+
+def smart_uv_project():
+    """Pre-defined settings for existing uv projection OT"""
+    bpy.ops.uv.smart_project(
+        angle_limit=66,
+        island_margin=0.02,
+        user_area_weight=0,
+        use_aspect=False,
+        stretch_to_bounds=True
+        )
+
+def topology_key(mesh, mode):
+    """Returns the cache key of projecting mesh in mode"""
+    digest = hashlib.md5()
+    digest.update(raster.vertex_coords(mesh).tobytes())
+    digest.update(raster.loop_vertices(mesh).tobytes())
+    loop_total = raster.int_array(mesh.polygons, 'loop_total', len(mesh.polygons))
+    digest.update(loop_total.tobytes())
+    digest.update(mode.encode())
+    return digest.hexdigest()
+
+def lookup(key):
+    """Returns the cached layout of key, None if there is none"""
+    uvs = _CACHE.get(key)
+    if uvs is not None:
+        _CACHE.move_to_end(key)
+    return uvs
+
+def store(key, uvs):
+    _CACHE[key] = uvs
+    _CACHE.move_to_end(key)
+    while len(_CACHE) > CACHE_SIZE:
+        _CACHE.popitem(last=False)
+
+def clear_cache():
+    _CACHE.clear()
+
+####################################
+####    BOX
+#
+
+def loop_polygons(mesh):
+    """Returns the polygon index of every loop"""
+    poly_count = len(mesh.polygons)
+    loop_start = raster.int_array(mesh.polygons, 'loop_start', poly_count)
+    loop_total = raster.int_array(mesh.polygons, 'loop_total', poly_count)
+    first = np.cumsum(loop_total) - loop_total
+    loops = np.repeat(loop_start, loop_total) + np.arange(loop_total.sum()) - np.repeat(first, loop_total)
+    loop_poly = np.zeros(len(mesh.loops), dtype=np.int64)
+    loop_poly[loops] = np.repeat(np.arange(poly_count), loop_total)
+    return loop_poly
+
+def box_project(mesh):
+    """Returns the box projected uv coordinate of every loop (L, 2). Texel density is the same on every side"""
+    co = raster.vertex_coords(mesh).astype(np.float64)
+    if not len(co) or not len(mesh.loops):
+        return np.zeros((len(mesh.loops), 2), dtype=np.float32)
+    normals = np.empty(len(mesh.polygons) * 3, dtype=np.float32)
+    mesh.polygons.foreach_get('normal', normals)
+    normals = normals.reshape(-1, 3)
+    axis = np.abs(normals).argmax(axis=1)
+    side = axis * 2 + (normals[np.arange(len(normals)), axis] < 0.0)
+
+    #Positions in the bounding box, scaled by its longest edge so every side keeps the same density.
+    lo = co.min(axis=0)
+    size = co.max(axis=0) - lo
+    extent = max(size.max(), 1e-12)
+    local = (co - lo) / extent
+    size = size / extent
+
+    loop_side = side[loop_polygons(mesh)]
+    loop_co = local[raster.loop_vertices(mesh)]
+    rows = np.arange(len(loop_co))
+    uv = np.empty((len(loop_co), 2), dtype=np.float64)
+    for i, table in enumerate((BOX_U, BOX_V)):
+        axes, signs = table[loop_side, 0], table[loop_side, 1]
+        values = loop_co[rows, axes]
+        uv[:, i] = np.where(signs > 0, values, size[axes] - values)
+
+    #Sides go into a 3 x 2 grid of cells.
+    cell = np.array([1.0 / 3.0, 0.5])
+    scale = cell[0] * (1.0 - 2.0 * PADDING)
+    corner = np.stack((loop_side % 3, loop_side // 3), axis=1) * cell + (cell - scale) / 2.0
+    return (uv * scale + corner).astype(np.float32)
+
+####################################
+####    PROJECTING
+#
+
+def apply_layout(mesh, uvs):
+    """Adds a uv layer to mesh holding uvs"""
+    texture = mesh.uv_textures.new()
+    mesh.uv_layers[texture.name].data.foreach_set('uv', uvs.ravel())
+    mesh.update()
+
+def smart_project(context, objects):
+    """Runs smart uv project on each object on its own, not packed together"""
+    scn = context.scene
+    active = scn.objects.active
+    selected = [ob for ob in scn.objects if ob.select]
+    for ob in selected:
+        ob.select = False
+    try:
+        for ob in objects:
+            ob.select = True
+            scn.objects.active = ob
+            ob.data.uv_textures.new()
+            smart_uv_project()
+            ob.select = False
+    finally:
+        for ob in objects:
+            ob.select = False
+        for ob in selected:
+            ob.select = True
+        scn.objects.active = active
+
+def project(context, objects, mode='SMART'):
+    """Gives every mesh object of objects without a uv layout one, from the cache where possible.
+    Returns the number of meshes that had to be projected"""
+    missing = []
+    meshes = set()
+    for ob in objects:
+        if ob.type == 'MESH' and len(ob.data.uv_textures) == 0 and ob.data not in meshes:
+            meshes.add(ob.data)
+            missing.append(ob)
+    if not missing:
+        return 0
+
+    #Meshes of the same shape are projected once, the rest copy the layout.
+    groups = OrderedDict()
+    for ob in missing:
+        groups.setdefault(topology_key(ob.data, mode), []).append(ob)
+    fresh = []
+    for key, group in groups.items():
+        uvs = lookup(key)
+        if uvs is None and mode == 'BOX':
+            with gp_profile.span("UV projection", group[0]):
+                uvs = box_project(group[0].data)
+            store(key, uvs)
+            fresh.append(key)
+        if uvs is not None:
+            for ob in group:
+                apply_layout(ob.data, uvs)
+
+    unwrap = [(key, group) for key, group in groups.items() if len(group[0].data.uv_textures) == 0]
+    if unwrap:
+        with gp_profile.span("UV projection", unwrap[0][1][0] if len(unwrap) == 1 else None):
+            smart_project(context, [group[0] for key, group in unwrap])
+        for key, group in unwrap:
+            uvs = raster.uv_coords(group[0].data).copy()
+            store(key, uvs)
+            fresh.append(key)
+            for ob in group[1:]:
+                apply_layout(ob.data, uvs)
+    return len(fresh)
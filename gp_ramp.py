@@ -0,0 +1,125 @@
+import numpy as np
+from collections import OrderedDict
+import gp_raster as raster
+import gp_pixels as px
+
+#INFO:
+#       Compiles a ColorRamp(ShaderNodeValToRGB) into a lookup table, so a gradient can be applied to a mask
+#       with a single NumPy take instead of a Cycles bake. LUTs are cached by the state of the ramp.
+
+LUT_SIZE = 4096
+CACHE_SIZE = 64
+
+#Weights Cycles uses when a color is plugged into a float socket.
+LUMINANCE = np.array((0.2126, 0.7152, 0.0722), dtype=np.float32)
+
+_LUTS = OrderedDict()
+
+def ramp_state(color_ramp):
+    """Returns a hashable snapshot of everything that affects the ramp's output"""
+    elements = tuple((e.position, tuple(e.color)) for e in color_ramp.elements)
+    return (color_ramp.color_mode, color_ramp.interpolation, color_ramp.hue_interpolation, elements)
+
+def _compile_rgb(elements, interpolation, size):
+    """Returns the LUT of an RGB ramp with LINEAR, EASE or CONSTANT interpolation"""
+    elements = sorted(elements, key=lambda e: e[0])
+    pos = np.array([e[0] for e in elements], dtype=np.float64)
+    col = np.array([e[1] for e in elements], dtype=np.float64)
+    t = np.linspace(0.0, 1.0, size)
+    if len(pos) == 1:
+        return np.tile(col[0], (size, 1)).astype(np.float32)
+
+    #Index of the element to the right of every sample, clamped so a left neighbour always exists.
+    right = np.clip(np.searchsorted(pos, t, side='right'), 1, len(pos) - 1)
+    left = right - 1
+    if interpolation == 'CONSTANT':
+        idx = np.clip(np.searchsorted(pos, t, side='right') - 1, 0, len(pos) - 1)
+        lut = col[idx]
+    else:
+        span = pos[right] - pos[left]
+        fac = np.where(span > 0.0, (t - pos[left]) / np.where(span > 0.0, span, 1.0), 0.0)
+        fac = np.clip(fac, 0.0, 1.0)
+        if interpolation == 'EASE':
+            fac = fac * fac * (3.0 - 2.0 * fac)
+        lut = col[left] + (col[right] - col[left]) * fac[:, None]
+    #Outside the outer elements the ramp holds the end colors.
+    lut[t <= pos[0]] = col[0]
+    lut[t >= pos[-1]] = col[-1]
+    return lut.astype(np.float32)
+
+def compile_ramp(color_ramp, size=LUT_SIZE):
+    """Returns a (size, 4) float LUT of the ramp. Cached by ramp state"""
+    state = ramp_state(color_ramp)
+    key = (state, size)
+    lut = _LUTS.get(key)
+    if lut is not None:
+        _LUTS.move_to_end(key)
+        return lut
+
+    color_mode, interpolation, hue_interpolation, elements = state
+    if color_mode == 'RGB' and interpolation in {'LINEAR', 'EASE', 'CONSTANT'}:
+        lut = _compile_rgb(elements, interpolation, size)
+    else:
+        #Splines and HSV/HSL blending are left to Blender's own evaluation.
+        lut = np.array([color_ramp.evaluate(t) for t in np.linspace(0.0, 1.0, size)], dtype=np.float32)
+
+    _LUTS[key] = lut
+    while len(_LUTS) > CACHE_SIZE:
+        _LUTS.popitem(last=False)
+    return lut
+
+def clear_cache():
+    _LUTS.clear()
+
+def apply_lut(lut, values):
+    """Returns values (any shape) in 0-1 mapped through lut, with a trailing color axis"""
+    idx = np.rint(np.clip(values, 0.0, 1.0) * (len(lut) - 1)).astype(np.int64)
+    return lut[idx]
+
+def resample_nearest(buf, width, height):
+    """Returns buf (H, W, C) resized to (height, width) by nearest neighbour"""
+    src_h, src_w = buf.shape[:2]
+    if (src_w, src_h) == (width, height):
+        return buf
+    rows = ((np.arange(height) + 0.5) * src_h / height).astype(np.int64)
+    cols = ((np.arange(width) + 0.5) * src_w / width).astype(np.int64)
+    return buf[rows][:, cols]
+
+def ramp_image(color_ramp, mask, target):
+    """Writes mask mapped through color_ramp into target, the way a Cycles bake of the material would. Returns target"""
+    width, height = target.size
+    buf = resample_nearest(px.read(mask, 'ramp_mask'), width, height)
+    rgb = px.rgb(buf)
+    if raster.is_srgb(mask):
+        rgb = raster.srgb_to_linear(rgb)
+    fac = rgb @ LUMINANCE
+
+    out = px.buffer(width, height, 'ramp')
+    px.rgb(out)[:] = apply_lut(compile_ramp(color_ramp), fac)[..., :3]
+    px.alpha(out)[:] = 1.0
+    if raster.is_srgb(target):
+        px.rgb(out)[:] = raster.linear_to_srgb(px.rgb(out))
+    px.write(target, out)
+    return target
+
+def sample_bilinear(buf, uvs):
+    """Returns buf (H, W, C) sampled at uvs (N, 2) with bilinear filtering, clamped at the borders"""
+    height, width = buf.shape[:2]
+    x = np.clip(uvs[:, 0] * width - 0.5, 0.0, width - 1)
+    y = np.clip(uvs[:, 1] * height - 0.5, 0.0, height - 1)
+    x0 = np.minimum(x.astype(np.int64), width - 2) if width > 1 else np.zeros(len(x), dtype=np.int64)
+    y0 = np.minimum(y.astype(np.int64), height - 2) if height > 1 else np.zeros(len(y), dtype=np.int64)
+    x1 = np.minimum(x0 + 1, width - 1)
+    y1 = np.minimum(y0 + 1, height - 1)
+    fx = (x - x0)[:, None]
+    fy = (y - y0)[:, None]
+    bottom = buf[y0, x0] * (1.0 - fx) + buf[y0, x1] * fx
+    top = buf[y1, x0] * (1.0 - fx) + buf[y1, x1] * fx
+    return bottom * (1.0 - fy) + top * fy
+
+def ramp_loops(color_ramp, mask, mesh):
+    """Returns the linear color (L, 4) of every loop: mask sampled at the loop's uv, mapped through color_ramp"""
+    rgb = sample_bilinear(px.rgb(px.read(mask, 'ramp_mask')), raster.uv_coords(mesh))
+    if raster.is_srgb(mask):
+        rgb = raster.srgb_to_linear(rgb)
+    return apply_lut(compile_ramp(color_ramp), rgb @ LUMINANCE)
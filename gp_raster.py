@@ -0,0 +1,265 @@
+import hashlib
+import numpy as np
+from collections import OrderedDict
+import gp_pixels as px
+
+#INFO:
+#       Rasterizes a mesh's UV layout on the CPU. The result is a coverage index that maps every covered
+#       pixel to the triangle it lies in plus the barycentric weights inside that triangle.
+#       Maps that are pure functions of mesh data(POS, CURVE, ID) interpolate over this index instead
+#       of going through a Cycles bake.
+
+CACHE_SIZE = 512            #MB of coverage indices kept around. One at 4K is about 470 MB.
+CHUNK_SIZE = 1 << 22        #Max candidate pixels tested at once. Bounds memory on large triangles.
+EPSILON = 1e-6
+
+_CACHE = OrderedDict()
+_CACHE_BYTES = 0
+
+####################################
+####    MESH DATA
+#
+
+def int_array(collection, attribute, count):
+    """Returns an int property of every item of collection as int64 (count,). Blender stores ints as 32 bit
+    and foreach_get only copies straight into a buffer of the same type, so it is read as int32 and widened"""
+    values = np.empty(count, dtype=np.int32)
+    collection.foreach_get(attribute, values)
+    return values.astype(np.int64)
+
+def loop_triangles(mesh):
+    """Returns fan triangulated loop indices (T, 3) and the polygon index of every triangle (T,)"""
+    poly_count = len(mesh.polygons)
+    loop_start = int_array(mesh.polygons, 'loop_start', poly_count)
+    loop_total = int_array(mesh.polygons, 'loop_total', poly_count)
+
+    tri_count = np.maximum(loop_total - 2, 0)
+    tri_poly = np.repeat(np.arange(poly_count), tri_count)
+    first = np.cumsum(tri_count) - tri_count
+    k = np.arange(len(tri_poly)) - np.repeat(first, tri_count) + 1
+    start = loop_start[tri_poly]
+    tris = np.stack((start, start + k, start + k + 1), axis=1)
+    return tris, tri_poly
+
+def loop_vertices(mesh):
+    """Returns the vertex index of every loop"""
+    loop_vert = int_array(mesh.loops, 'vertex_index', len(mesh.loops))
+    return loop_vert
+
+def vertex_coords(mesh):
+    """Returns object space vertex coordinates (V, 3)"""
+    co = np.empty(len(mesh.vertices) * 3, dtype=np.float32)
+    mesh.vertices.foreach_get('co', co)
+    return co.reshape(-1, 3)
+
+def uv_coords(mesh, uv_layer=None):
+    """Returns the uv coordinate of every loop (L, 2). Uses the active layer if none is given"""
+    if uv_layer is None:
+        uv_layer = mesh.uv_layers.active
+    uvs = np.empty(len(mesh.loops) * 2, dtype=np.float32)
+    uv_layer.data.foreach_get('uv', uvs)
+    return uvs.reshape(-1, 2)
+
+####################################
+####    RASTERIZING
+#
+
+class Coverage:
+    """Per-pixel triangle id and barycentric weights of a uv layout"""
+
+    def __init__(self, width, height, pixels, tris, bary):
+        self.width = width
+        self.height = height
+        self.pixels = pixels    #Flat pixel index (N,), row 0 is the bottom row like Image.pixels
+        self.tris = tris        #Triangle id of each covered pixel (N,)
+        self.bary = bary        #Barycentric weights (N, 3)
+        self.tri_loops = None   #Loop indices of each triangle (T, 3), set by get_coverage
+        self.tri_polys = None   #Polygon index of each triangle (T,), set by get_coverage
+
+    def interpolate(self, corner_values):
+        """Returns corner_values (T, 3) or (T, 3, C) interpolated to every covered pixel"""
+        values = corner_values[self.tris]
+        if values.ndim == 2:
+            return np.einsum('nk,nk->n', self.bary, values)
+        return np.einsum('nk,nkc->nc', self.bary, values)
+
+    def subset(self, selection):
+        """Returns a Coverage of only the selected covered pixels"""
+        coverage = Coverage(self.width, self.height, self.pixels[selection], self.tris[selection], self.bary[selection])
+        coverage.tri_loops = self.tri_loops
+        coverage.tri_polys = self.tri_polys
+        return coverage
+
+    def nbytes(self):
+        size = self.pixels.nbytes + self.tris.nbytes + self.bary.nbytes
+        for array in (self.tri_loops, self.tri_polys):
+            if array is not None:
+                size += array.nbytes
+        return size
+
+    def mask(self):
+        """Returns a boolean (height, width) array of covered pixels"""
+        covered = np.zeros(self.width * self.height, dtype=bool)
+        covered[self.pixels] = True
+        return covered.reshape(self.height, self.width)
+
+def rasterize(uvs, tris, width, height):
+    """Returns a Coverage of the triangles tris (T, 3) indexing into uvs (L, 2). Later triangles win overlaps"""
+    corners = uvs[tris].astype(np.float64) * (width, height)
+    lo = np.ceil(corners.min(axis=1) - 0.5).astype(np.int64)
+    hi = np.floor(corners.max(axis=1) - 0.5).astype(np.int64)
+    lo = np.maximum(lo, 0)
+    hi = np.minimum(hi, (width - 1, height - 1))
+
+    a = corners[:, 0]
+    v0 = corners[:, 1] - a
+    v1 = corners[:, 2] - a
+    denom = v0[:, 0] * v1[:, 1] - v1[:, 0] * v0[:, 1]
+
+    box = np.maximum(hi - lo + 1, 0)
+    counts = box[:, 0] * box[:, 1]
+    counts[np.abs(denom) < EPSILON] = 0     #Degenerate in uv space, covers nothing.
+
+    ends = np.cumsum(counts)
+    found_pixels, found_tris, found_bary = [], [], []
+    start = 0
+    while start < len(counts):
+        #Take as many triangles as fit in one chunk, but always at least one.
+        stop = np.searchsorted(ends, ends[start] - counts[start] + CHUNK_SIZE, side='right')
+        stop = max(stop, start + 1)
+        cnt = counts[start:stop]
+        total = int(cnt.sum())
+        if total:
+            tid = np.repeat(np.arange(start, stop), cnt)
+            off = np.arange(total) - np.repeat(np.cumsum(cnt) - cnt, cnt)
+            box_w = box[tid, 0]
+            px = lo[tid, 0] + off % box_w
+            py = lo[tid, 1] + off // box_w
+
+            v2x = px + 0.5 - a[tid, 0]
+            v2y = py + 0.5 - a[tid, 1]
+            d = denom[tid]
+            l1 = (v2x * v1[tid, 1] - v1[tid, 0] * v2y) / d
+            l2 = (v0[tid, 0] * v2y - v2x * v0[tid, 1]) / d
+            l0 = 1.0 - l1 - l2
+            inside = (l0 >= -EPSILON) & (l1 >= -EPSILON) & (l2 >= -EPSILON)
+
+            found_pixels.append((py * width + px)[inside])
+            found_tris.append(tid[inside])
+            found_bary.append(np.stack((l0, l1, l2), axis=1)[inside])
+        start = stop
+
+    if not found_pixels:
+        empty = np.empty(0, dtype=np.int64)
+        return Coverage(width, height, empty, empty, np.empty((0, 3)))
+
+    pixels = np.concatenate(found_pixels)
+    tri_ids = np.concatenate(found_tris)
+    bary = np.concatenate(found_bary).astype(np.float32)
+    #Keep the last triangle written to each pixel.
+    _, first = np.unique(pixels[::-1], return_index=True)
+    keep = len(pixels) - 1 - first
+    return Coverage(width, height, pixels[keep], tri_ids[keep], bary[keep])
+
+def get_coverage(mesh, width, height, uv_layer=None, cache=True):
+    """Returns a cached Coverage for mesh, uv layer and resolution. Rasterizes only if the layout changed.
+    Without cache it is neither looked up nor stored, for temporary meshes whose pointer Blender reuses"""
+    if uv_layer is None:
+        uv_layer = mesh.uv_layers.active
+    uvs = uv_coords(mesh, uv_layer)
+    tris, tri_poly = loop_triangles(mesh)
+    digest = hashlib.md5(uvs.tobytes())
+    digest.update(tris.tobytes())
+    digest = digest.digest()
+
+    if not cache:
+        coverage = rasterize(uvs, tris, width, height)
+        coverage.tri_loops = tris
+        coverage.tri_polys = tri_poly
+        return coverage
+    key = (mesh.as_pointer(), uv_layer.name, width, height)
+    entry = _CACHE.get(key)
+    if entry is not None and entry[0] == digest:
+        _CACHE.move_to_end(key)
+        return entry[1]
+
+    global _CACHE_BYTES
+    coverage = rasterize(uvs, tris, width, height)
+    coverage.tri_loops = tris
+    coverage.tri_polys = tri_poly
+    if entry is not None:
+        _CACHE_BYTES -= entry[1].nbytes()
+    _CACHE[key] = (digest, coverage)
+    _CACHE.move_to_end(key)
+    _CACHE_BYTES += coverage.nbytes()
+    #The index just made always stays, even if it is bigger than the cache on its own.
+    while _CACHE_BYTES > CACHE_SIZE * 1024 * 1024 and len(_CACHE) > 1:
+        old_key, (old_digest, old) = _CACHE.popitem(last=False)
+        _CACHE_BYTES -= old.nbytes()
+    return coverage
+
+def clear_cache():
+    global _CACHE_BYTES
+    _CACHE.clear()
+    _CACHE_BYTES = 0
+
+####################################
+####    IMAGE OUTPUT
+#
+
+def dilate(buf, covered, margin):
+    """Bleeds covered pixels of buf (H, W, C) outwards by margin pixels, to avoid visible seams"""
+    covered = covered.copy()
+    for i in range(int(margin)):
+        total = np.zeros_like(buf)
+        count = np.zeros(covered.shape, dtype=np.float32)
+        for axis, shift in ((0, 1), (0, -1), (1, 1), (1, -1)):
+            src = np.roll(covered, shift, axis=axis)
+            vals = np.roll(buf, shift, axis=axis)
+            #np.roll wraps around, so drop whatever came across the border.
+            edge = 0 if shift > 0 else -1
+            if axis == 0:
+                src[edge, :] = False
+            else:
+                src[:, edge] = False
+            total[src] += vals[src]
+            count += src
+        grow = (count > 0) & ~covered
+        if not grow.any():
+            break
+        buf[grow] = total[grow] / count[grow][:, None]
+        covered |= grow
+    return buf
+
+def is_srgb(image):
+    """Byte images in sRGB store display encoded values. Bakes write to them encoded, shaders read them decoded"""
+    return not image.is_float and image.colorspace_settings.name == 'sRGB'
+
+def linear_to_srgb(rgb):
+    rgb = np.clip(rgb, 0.0, 1.0)
+    return np.where(rgb <= 0.0031308, rgb * 12.92, 1.055 * np.power(rgb, 1.0 / 2.4) - 0.055)
+
+def srgb_to_linear(rgb):
+    rgb = np.clip(rgb, 0.0, 1.0)
+    return np.where(rgb <= 0.04045, rgb / 12.92, np.power((rgb + 0.055) / 1.055, 2.4))
+
+def encode_values(image, values):
+    """Returns linear per-pixel values (N,) or colors (N, 3) as the (N, 3) colors a bake would store in image"""
+    if values.ndim == 1:
+        rgb = np.repeat(values[:, None], 3, axis=1)
+    else:
+        rgb = values[:, :3]
+    if is_srgb(image):
+        rgb = linear_to_srgb(rgb)
+    return rgb
+
+def write_coverage(image, coverage, values, margin=0):
+    """Writes linear per-pixel values (N,) or colors (N, 3) into image, the way a bake would. Uncovered pixels are black"""
+    buf = px.buffer(coverage.width, coverage.height, 'bake')
+    rows = px.pixel_rows(buf)
+    rows[:] = (0.0, 0.0, 0.0, 1.0)
+    rows[coverage.pixels, :3] = encode_values(image, values)
+    if margin:
+        dilate(buf, coverage.mask(), margin)
+    px.write(image, buf)
+    return image
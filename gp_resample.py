@@ -0,0 +1,73 @@
+import numpy as np
+import gp_raster as raster
+import gp_pixels as px
+
+#INFO:
+#       Resampling of bakes. A master bake at the highest resolution is downsampled to lower resolutions and
+#       LOD chains instead of rendering each size again. Pixels are averaged by area, weighted by uv coverage,
+#       so the margin around islands never bleeds across seams. The margin is dilated again at the new size.
+
+EPSILON = 1e-9
+
+def lod_sizes(width, height, count):
+    """Returns the sizes of an LOD chain, starting at width x height and halving count - 1 times"""
+    return [(max(1, width >> i), max(1, height >> i)) for i in range(max(1, count))]
+
+def can_resample(source, width, height):
+    """Returns True if source is at least width x height, downsampling only"""
+    return source.size[0] >= width and source.size[1] >= height
+
+def resample_axis(buf, size, axis):
+    """Returns buf with axis shrunk to size. Every source pixel is split over the target pixels it overlaps"""
+    count = buf.shape[axis]
+    scale = size / count
+    start = np.arange(count) * scale
+    first = np.minimum(np.floor(start).astype(np.int64), size - 1)
+    inside = np.minimum(start + scale, first + 1) - start
+    buf = np.moveaxis(buf, axis, 0)
+    shape = (-1,) + (1,) * (buf.ndim - 1)
+    out = np.zeros((size,) + buf.shape[1:], dtype=np.float32)
+    #A source pixel covers at most two target pixels when shrinking, the one it starts in and the next.
+    for weights, target in ((inside, first), (scale - inside, first + 1)):
+        keep = (weights > EPSILON) & (target < size)
+        if not keep.any():
+            continue
+        target = target[keep]
+        starts = np.flatnonzero(np.r_[True, target[1:] != target[:-1]])
+        out[target[starts]] += np.add.reduceat(buf[keep] * weights[keep].reshape(shape), starts, axis=0)
+    return np.moveaxis(out, 0, axis)
+
+def resample(buf, covered, width, height):
+    """Returns buf (H, W, C) shrunk to (height, width, C) and the summed coverage weight of every target pixel.
+    Only covered source pixels contribute"""
+    weight = covered.astype(np.float32)
+    total = resample_axis(resample_axis(buf * weight[:, :, None], height, 0), width, 1)
+    weight = resample_axis(resample_axis(weight, height, 0), width, 1)
+    filled = weight > EPSILON
+    total[filled] /= weight[filled][:, None]
+    return total, weight
+
+def scaled_margin(margin, source, width):
+    """Returns the bake margin of source scaled to a width, at least a pixel if there is one"""
+    if not margin:
+        return 0
+    return max(1, int(round(margin * width / source.size[0])))
+
+def resample_image(source, target, mesh, margin=0):
+    """Writes source downsampled to the size of target, using the uv coverage of mesh. Returns target"""
+    width, height = target.size
+    buf = px.read(source, 'resample')
+    if raster.is_srgb(source):
+        px.rgb(buf)[:] = raster.srgb_to_linear(px.rgb(buf))
+    covered = raster.get_coverage(mesh, source.size[0], source.size[1]).mask()
+    out, weight = resample(buf, covered, width, height)
+
+    #Pixels of islands too small to survive the source resolution are refilled by the margin.
+    covered = raster.get_coverage(mesh, width, height).mask() & (weight > EPSILON)
+    out[~covered] = (0.0, 0.0, 0.0, 1.0)
+    if raster.is_srgb(target):
+        px.rgb(out)[:] = raster.linear_to_srgb(px.rgb(out))
+    if margin:
+        raster.dilate(out, covered, margin)
+    px.write(target, out)
+    return target
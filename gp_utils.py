@@ -1,4 +1,119 @@
 import bpy
+import numpy as np
+from bpy.app.handlers import persistent
+import gp_raster as raster
+
+#INFO:
+#       Registry of ID tagged datablocks. Materials are keyed by their 'ID', images by ('ID', 'mask' or 'type').
+#       GameTexTools bakes are images of their own, keyed by (BAKE_OWNER, BAKE_MAP).
+#       Built from bpy.data on first use and again after load/undo/redo, so lookups don't have to scan bpy.data.
+#       Never built while registering, bpy.data can't be read while add-ons are enabled at startup.
+
+BAKE_OWNER = 'GP_owner'    #ID of the object a GameTexTools image was baked for.
+BAKE_MAP = 'GP_map'         #Map type a GameTexTools image holds.
+
+_REGISTRY = {'MAT': {}, 'IMG': {}, 'BAKE': {}}
+_REGISTRY_READY = False
+
+def item_key(item, data):
+    """Returns the registry key of a tagged datablock, None if it isn't tagged"""
+    if item == 'BAKE':
+        if data.library is not None or data.get(BAKE_MAP) is None:
+            return None
+        return (data.get(BAKE_OWNER), data[BAKE_MAP])
+    ID = data.get('ID')
+    if ID is None:
+        return None
+    if item == 'MAT':
+        return ID
+    tag = data.get('mask')
+    if tag is None:
+        tag = data.get('type')
+    return (ID, tag)
+
+def rebuild_registry():
+    global _REGISTRY_READY
+    for item, datablocks in (('MAT', bpy.data.materials), ('IMG', bpy.data.images), ('BAKE', bpy.data.images)):
+        table = _REGISTRY[item]
+        table.clear()
+        for data in datablocks:
+            key = item_key(item, data)
+            if key is not None:
+                table[key] = data
+    _REGISTRY_READY = True
+
+def invalidate_registry():
+    """Makes the next lookup rebuild the registry"""
+    global _REGISTRY_READY
+    _REGISTRY_READY = False
+    for table in _REGISTRY.values():
+        table.clear()
+
+def register_item(item, data):
+    """Adds a tagged datablock to the registry. Call after setting its tags"""
+    if not _REGISTRY_READY:
+        rebuild_registry()
+    key = item_key(item, data)
+    if key is not None:
+        _REGISTRY[item][key] = data
+
+def unregister_item(item, data):
+    """Removes a datablock from the registry. Call before removing it from bpy.data"""
+    key = item_key(item, data)
+    if _REGISTRY[item].get(key) is data:
+        del _REGISTRY[item][key]
+
+def find_item(item, ID, mask=None):
+    """Returns the datablock tagged with ID (and mask for images). Returns None if there is none"""
+    if ID is None:
+        return None
+    if not _REGISTRY_READY:
+        rebuild_registry()
+    key = ID if item == 'MAT' else (ID, mask)
+    data = _REGISTRY[item].get(key)
+    if data is None:
+        return None
+    try:
+        if item_key(item, data) == key:
+            return data
+    except ReferenceError:
+        pass
+    #Removed or retagged behind our back, start over.
+    rebuild_registry()
+    return _REGISTRY[item].get(key)
+
+@persistent
+def registry_handler(scene):
+    invalidate_registry()
+
+REGISTRY_HANDLERS = (
+    bpy.app.handlers.load_post,
+    bpy.app.handlers.undo_post,
+    bpy.app.handlers.redo_post,
+)
+
+_HANDLER_USERS = 0  #Add-ons that registered the handlers. They stay until the last one unregisters.
+
+def register_handlers():
+    global _HANDLER_USERS
+    _HANDLER_USERS += 1
+    for handlers in REGISTRY_HANDLERS:
+        if registry_handler not in handlers:
+            handlers.append(registry_handler)
+    if id_counter_handler not in bpy.app.handlers.load_post:
+        bpy.app.handlers.load_post.append(id_counter_handler)
+    invalidate_registry()
+
+def unregister_handlers():
+    global _HANDLER_USERS
+    _HANDLER_USERS = max(_HANDLER_USERS - 1, 0)
+    if _HANDLER_USERS:
+        return
+    for handlers in REGISTRY_HANDLERS:
+        if registry_handler in handlers:
+            handlers.remove(registry_handler)
+    if id_counter_handler in bpy.app.handlers.load_post:
+        bpy.app.handlers.load_post.remove(id_counter_handler)
 
 def min_vertex(mesh, axis):
     for i, vt in enumerate(mesh.vertices):
@@ -11,24 +126,10 @@ def min_vertex(mesh, axis):
 
 def get_item(context, item, ob, mask=None):
     """Returns item of interest if existing. Returns none if not"""
-    if item == 'MAT':
-        for mat in bpy.data.materials:
-            try:
-                if mat['ID'] == ob['ID']:
-                    return mat
-            except:
-                continue
-        return None
-    elif item == 'IMG':
-        for img in bpy.data.images:
-            try:
-                if img['ID'] == ob['ID'] and img['mask'] == mask:
-                    return img
-            except:
-                continue
-        return None
-    else:
+    if item not in _REGISTRY:
         print("Wrong ID types!")
+        return None
+    return find_item(item, ob.get('ID'), mask)
 
 def get_mat(context, ob):
     """Returns/creates material that fits object ID"""
@@ -36,6 +137,7 @@ def get_mat(context, ob):
     if mat is None:
         mat = bpy.data.materials.new(ob.name)
         mat['ID'] = ob['ID']
+        register_item('MAT', mat)
     return mat
 
 def get_img(ob, name, width, height):
@@ -44,26 +146,60 @@ def get_img(ob, name, width, height):
     if img is None:
         img = bpy.data.images.new(name, width, height)
         img.use_fake_user = True
-        img.pack(as_png=True)
         img['ID'] = ob['ID']
+        register_item('IMG', img)
     return img
 
-def check_id(context, ob):
-    try:
-        if ob['ID'] >= 0:
-            return ob
-    except:
-        pass
+def write_vertex_colors(mesh, name, colors):
+    """Writes linear per loop colors (L, 3) into the vertex color layer name, created if missing. Returns the layer
+    Vertex colors are stored display encoded, like Blender's own vertex paint"""
+    layer = mesh.vertex_colors.get(name)
+    if layer is None:
+        layer = mesh.vertex_colors.new(name=name)
+    mesh.vertex_colors.active = layer
+    colors = raster.linear_to_srgb(colors[:, :3])
+    if len(layer.data) and len(layer.data[0].color) == 4:
+        colors = np.concatenate((colors, np.ones((len(colors), 1))), axis=1)
+    layer.data.foreach_set('color', np.ascontiguousarray(colors, dtype=np.float32).ravel())
+    mesh.update()
+    return layer
+
+####################################
+####    OBJECT IDs
+#
+
+ID_COUNTER = 'GrP_next_ID'      #Scene property the counter is saved in.
+_NEXT_ID = None
 
-    ob_IDs = []
+def rebuild_id_counter():
+    """Moves the counter past every ID in use. Runs once per loaded file"""
+    global _NEXT_ID
+    counter = 0
     for ob in bpy.data.objects:
-        try:
-            if ob['ID'] >= 0:
-                ob_IDs.append(ob['ID'])
-        except:
-            continue
-    
-    if len(ob_IDs) == 0:
-        ob['ID'] = 0
-    else:
-        ob['ID'] += max(ob_IDs)
\ No newline at end of file
+        ID = ob.get('ID')
+        if ID is not None and ID >= counter:
+            counter = ID + 1
+    for scn in bpy.data.scenes:
+        counter = max(counter, scn.get(ID_COUNTER, 0))
+    _NEXT_ID = counter
+
+def next_id():
+    """Returns a new unique object ID"""
+    global _NEXT_ID
+    if _NEXT_ID is None:
+        rebuild_id_counter()
+    ID = _NEXT_ID
+    _NEXT_ID += 1
+    bpy.context.scene[ID_COUNTER] = _NEXT_ID
+    return ID
+
+def check_id(context, ob):
+    """Gives the object an ID if it has none. Returns the object"""
+    if ob.get('ID') is None:
+        ob['ID'] = next_id()
+    return ob
+
+@persistent
+def id_counter_handler(scene):
+    global _NEXT_ID
+    _NEXT_ID = None
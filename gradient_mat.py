@@ -37,6 +37,8 @@ class GradientMat(bpy.types.Operator):
 
 def register():
     bpy.util.register_class(GradientMat)
+    gp.register_handlers()
 
 def unregister():
-    bpy.utils.unregister_class(GradientMat)
\ No newline at end of file
+    bpy.utils.unregister_class(GradientMat)
+    gp.unregister_handlers()
\ No newline at end of file
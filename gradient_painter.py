@@ -13,8 +13,23 @@ bl_info = {
 #       GrP_ID: Unique ID given to selected/active object. Used to keep track of generated maps, materials for said object.
 #       GrP_type: 'Special' Type of object. Distinquish e.g. multiple images for same object(Shared ID).
 #       GrP types = ('UV', 'PROJ', 'COL', 'AO')
+#       GPCOL: Vertex color layer the gradient is written to in the 'VERTEX' output mode, instead of a GPTEX image.
+#       Masters: the highest resolution bake of each mask is kept as '<type>_MASTER'. Lower resolutions and
+#       LODs('<type>_LOD<n>') are resampled from it instead of baked again, while the mesh is unchanged.
 
 import bpy
+import gp_utils as gp
+import gp_maps as maps
+import gp_pixels as px
+import gp_ramp
+import gp_cache
+import gp_resample
+import gp_pack
+import gp_preview
+import gp_profile
+import gp_memory
+import gp_bakemat
+import gp_projection
 from collections import OrderedDict
 from bpy.props import (
         StringProperty,
@@ -29,37 +44,25 @@ from bpy.props import (
 ####    UTILITIES
 #
 
-def min_vertex(mesh, axis):
-    for i, vt in enumerate(mesh.vertices):
-        v = eval('.'.join(['vt.co', axis]))
-        if i == 0:
-            min = v
-        if v < min:
-            min = v
-    return min
-
 def check_image_id(context, ob, map_type):
     """Removes existing image if ID exists, to bake on a new version(Resolution might have changed). Returns None"""
-    for img in bpy.data.images:
-        try:
-            if img['ID'] == ob['ID'] and img['mask'] == map_type:
-                bpy.data.images.remove(img, do_unlink=True)
-                return None
-        except:
-            continue
+    img = gp.find_item('IMG', ob.get('ID'), map_type)
+    if img is not None:
+        gp.unregister_item('IMG', img)
+        bpy.data.images.remove(img, do_unlink=True)
     return None
 
 def check_mat_id(context, ob, mask):
     """Returns mat if existing. Returns None if not"""
-    for mat in bpy.data.materials:
-        try:
-            if mat['ID'] == ob['ID']:
-                image_node = mat.node_tree.nodes['Image Texture']
-                image_node.image = mask
-                return mat
-        except:
-            continue
-    return None
+    mat = gp.find_item('MAT', ob.get('ID'))
+    if mat is None:
+        return None
+    try:
+        image_node = mat.node_tree.nodes['Image Texture']
+    except KeyError:
+        return None
+    image_node.image = mask
+    return mat
 
 def get_mat(context, ob, mask, type):
     """Returns/creates material that fits object ID"""
@@ -71,7 +74,8 @@ def get_mat(context, ob, mask, type):
         gptex = mat.node_tree.nodes.new("ShaderNodeTexImage")
         gptex.name = "GPTEX"
         mat['ID'] = ob['ID']
-        
+        gp.register_item('MAT', mat)
+
     return mat
 
 def get_img(ob, name, width, height, map_type):
@@ -82,26 +86,9 @@ def get_img(ob, name, width, height, map_type):
         img.use_fake_user = True
         img['ID'] = ob['ID']
         img['mask'] = map_type
+        gp.register_item('IMG', img)
     return img
 
-def check_id(context, obj):
-    if obj.get('ID') is not None:
-        print("ID is not None")
-        return
-    
-    ob_IDs = []
-    for ob in bpy.data.objects:
-        if ob.get('ID') is not None:
-            ob_IDs.append(ob['ID'])
-    
-    if len(ob_IDs) == 0:
-        obj['ID'] = 0
-        print("Length was 0")
-    else:
-        #Yes this is correct, don't do +=, it doesn't work.
-        obj['ID'] = max(ob_IDs) + 1
-        print("ID Should be added")
-
 ####################################
 ####    MASK BAKING
 #
@@ -113,17 +100,6 @@ def enable_color_bake_settings():
     bake_settings.use_pass_direct = False
     bake_settings.use_pass_indirect = False
 
-def create_bake_mat(context, name):
-    """Returns a material and the output node of that material"""
-    ob = context.active_object
-    mat = bpy.data.materials.new(name)
-    mat.use_nodes = True
-    out_node = mat.node_tree.nodes['Diffuse BSDF']
-    out_node.name = 'out'
-
-    return mat, out_node
-    
-
 def ao_mask(mask):
     """Returns an image with a baked Ambient Occlusion"""
     mask['mat'].node_tree.nodes.active = mask['image_node']
@@ -131,102 +107,116 @@ def ao_mask(mask):
     return mask['image']
 
 def position_mask(context, mask):
-    """Returns an image with a baked position mask"""
+    """Returns an image with a position mask along Z. Computed from the vertex coordinates, no render needed"""
     ob = context.active_object
-    scn = context.scene
-    nodes = mask['mat'].node_tree.nodes
-    #
-    #Nodes Creation
-    tex_coord = nodes.new("ShaderNodeTexCoord")
-    mapping = nodes.new("ShaderNodeMapping")
-    mapping.rotation[1] = 1.5708 #Radian rotation of 90 degrees in Y
-    mapping.translation[0] = abs(min_vertex(ob.data, 'z'))
-    gr_tex = nodes.new("ShaderNodeTexGradient")
-    #
-    #Nodes linking
-    links = mask['mat'].node_tree.links
-    links.new(tex_coord.outputs[3], mapping.inputs[0])
-    links.new(mapping.outputs[0], gr_tex.inputs[0])
-    links.new(gr_tex.outputs[0], mask['output'].inputs[0])
-    #
-    #Baking
-    mask['mat'].node_tree.nodes.active = mask['image_node']
-    enable_color_bake_settings()
-    bpy.ops.object.bake(type='DIFFUSE')
-    return mask['image']
+    return maps.position_map(ob, mask['image'], maps.AXES['Z'], context.scene.render.bake.margin)
 
 def curvature_mask(context, mask):
-    """Returns an image with a baked curvature map. Map baked on a subdivided version."""
-    bpy.ops.object.duplicate()
+    """Returns an image with a curvature mask. Computed from the dihedral angles of the mesh, no render needed"""
     ob = context.active_object
-    bpy.ops.object.modifier_add(type='SUBSURF')
-    subsurf = ob.modifiers[0]
-    subsurf.subdivision_type = 'SIMPLE'
-    
-    ##Subdivides a mesh to a number around 5k+. This is due to curvature being calculated on vertices.
-    while len(ob.data.vertices) < 5000:     #Number is currently an educated guess.
-        bpy.ops.object.mode_set(mode='EDIT')
-        bpy.ops.mesh.subdivide()
-        bpy.ops.object.mode_set(mode='OBJECT')
-
-    bpy.ops.object.mode_set(mode='OBJECT')
-
-    nodes = mask['mat'].node_tree.nodes
-    #Nodes Creation
-    geo = nodes.new("ShaderNodeNewGeometry")
-    #Nodes linking
-    links = mask['mat'].node_tree.links
-    links.new(geo.outputs[7], mask['output'].inputs[0])
-    #Baking
-    mask['mat'].node_tree.nodes.active = mask['image_node']
-    enable_color_bake_settings()
-    bpy.ops.object.bake(type='DIFFUSE')
-    bpy.ops.object.delete()
-
-    return mask['image']
+    return maps.curvature_map(ob, mask['image'], 0, context.scene.render.bake.margin)
+
+def get_master(ob, map_type):
+    """Returns the master bake of a mask type, None if there is none"""
+    return gp.find_item('IMG', ob.get('ID'), ''.join([map_type, '_MASTER']))
+
+def master_key(context, ob, map_type, master, settings=None):
+    """Returns the fingerprint the master would have if baked now. settings are the scene settings, if known"""
+    width, height = master.size
+    if settings is None:
+        settings = gp_cache.scene_settings(context.scene, ob, map_type)
+    return gp_cache.fingerprint(ob, map_type, width, height, settings)
+
+def valid_master(context, ob, map_type, width, height, settings=None):
+    """Returns the master if it is up to date and big enough to resample width x height from. Returns None if not"""
+    master = get_master(ob, map_type)
+    if master is None or not gp_resample.can_resample(master, width, height):
+        return None
+    if master.get('fingerprint') != master_key(context, ob, map_type, master, settings):
+        return None
+    return master
+
+def keep_master(ob, map_type, image, key):
+    """Copies a fresh bake into the master of its mask type. Returns the master"""
+    master = get_master(ob, map_type)
+    width, height = image.size
+    if not px.is_fast(image):
+        #Without foreach_get a copy through Python costs more than the bake, Blender copies the image in C.
+        if master is not None:
+            gp.unregister_item('IMG', master)
+            bpy.data.images.remove(master, do_unlink=True)
+        master = image.copy()
+        master.name = ''.join([ob.name, '_', map_type, '_master'])
+        master.use_fake_user = True
+        master['ID'] = ob['ID']
+        master['mask'] = ''.join([map_type, '_MASTER'])
+        gp.register_item('IMG', master)
+    elif master is None:
+        master = bpy.data.images.new(''.join([ob.name, '_', map_type, '_master']), width, height, float_buffer=image.is_float)
+        master.use_fake_user = True
+        master.colorspace_settings.name = image.colorspace_settings.name
+        master['ID'] = ob['ID']
+        master['mask'] = ''.join([map_type, '_MASTER'])
+        gp.register_item('IMG', master)
+    elif tuple(master.size) != (width, height):
+        master.scale(width, height)
+    if px.is_fast(image):
+        px.write(master, px.read(image, 'copy'))
+    master['fingerprint'] = key
+    gp_pack.defer(master)
+    gp_memory.touch(master)
+    return master
 
 def get_mask(context, width, height, map_type):
     """Returns an image with a baked map depending on the 'type' parameter"""
     mask = dict.fromkeys(['mat', 'output', 'image_node', 'image'])
-    context.scene.render.engine = 'CYCLES'
     ob = context.active_object
-    if ob.active_material:
-        original_mat = ob.active_material #Might want to handle this!
-        has_mat = True
+    mask['image'] = get_img(ob, ''.join([ob.name, '_', map_type]), width, height, map_type)
+    scn = context.scene
+    #The scene settings hash every occluder for AO, so they are gathered once for the cache and the master.
+    settings = gp_cache.scene_settings(scn, ob, map_type)
+    key = gp_cache.fingerprint(ob, map_type, width, height, settings)
+    use_cache = scn.use_bake_cache and gp_cache.worth_caching(mask['image'], map_type in maps.ANALYTIC_MAPS)
+    if use_cache:
+        gp_cache.set_size(scn.bake_cache_size)
+        gp_cache.set_disk(scn.bake_cache_dir, scn.bake_cache_disk_size)
+        if gp_cache.restore(mask['image'], key):
+            return mask['image']
+    master = valid_master(context, ob, map_type, width, height, settings)
+    if master is not None:
+        with gp_profile.span("Resample", ob):
+            img_mask = gp_resample.resample_image(master, mask['image'], ob.data, context.scene.render.bake.margin)
     else:
-        has_mat = False
+        #No master, or one that is stale or too small: this bake becomes the master.
+        with gp_profile.span(map_type, ob):
+            img_mask = bake_mask(context, mask, map_type)
+        keep_master(ob, map_type, img_mask, key)
+    if use_cache:
+        gp_cache.store(img_mask, key)
+    return img_mask
 
-    mask['mat'], mask['output'] = create_bake_mat(context, ''.join(['mask_', map_type])) #Output is actually a BSDF node
-    ob.active_material = mask['mat']
-    mask['image_node'] = mask['mat'].node_tree.nodes.new("ShaderNodeTexImage")
-    mask['image'] = get_img(ob, ''.join([ob.name, '_', map_type]), width, height, map_type)
-    mask['image_node'].image = mask['image']
+def bake_mask(context, mask, map_type):
+    """Bakes map_type into mask['image']. Returns the image"""
+    ob = context.active_object
 
-    if map_type == 'AO':
-        img_mask = ao_mask(mask)
-        print("Should bake!")
-    elif map_type == 'POS':
-        img_mask = position_mask(context, mask)
+    #Analytic masks are written straight into the image, without a bake material.
+    if map_type == 'POS':
+        return position_mask(context, mask)
     elif map_type == 'CURVE':
-        img_mask = curvature_mask(context, mask)
-    if has_mat:
-        ob.active_material = original_mat
-    bpy.data.materials.remove(mask['mat'], do_unlink=True)
-    return img_mask
+        return curvature_mask(context, mask)
 
-def smart_uv_project():
-    bpy.ops.uv.smart_project(
-        angle_limit=66,
-        island_margin=0.02,
-        user_area_weight=0,
-        use_aspect=False,
-        stretch_to_bounds=True
-        )
+    context.scene.render.engine = 'CYCLES'
+    with gp_bakemat.bound([(ob, mask['image'])], map_type) as templates:
+        mask['mat'] = templates[0]
+        mask['output'] = mask['mat'].node_tree.nodes[gp_bakemat.OUTPUT] #Output is actually a BSDF node
+        mask['image_node'] = mask['mat'].node_tree.nodes[gp_bakemat.TARGET]
+        if map_type == 'AO':
+            with gp_profile.span("Cycles AO", ob):
+                img_mask = ao_mask(mask)
+    return img_mask
 
 def handle_projection(context):
-    if len(context.object.data.uv_textures) == 0:
-        uv_map = context.object.data.uv_textures.new()
-        smart_uv_project()
+    gp_projection.project(context, [context.object], context.scene.projection_mode)
 
 
 
@@ -251,6 +241,24 @@ def add_node(context, mat, mask, type):
     
     return ramp_node
 
+def get_ramp_mask(mat):
+    """Returns the ramp node and the mask image feeding it, if the material is a plain mask->ramp setup. Returns None, None if not"""
+    for node in mat.node_tree.nodes:
+        if node.type != 'VALTORGB' or not node.inputs[0].links or not node.outputs[0].links:
+            continue
+        if node.outputs[0].links[0].to_node.type != 'BSDF_DIFFUSE':
+            continue
+        image_node = node.inputs[0].links[0].from_node
+        if image_node.name == "MASK" and image_node.image is not None:
+            return node, image_node.image
+    return None, None
+
+def update_live_preview(self, context):
+    if self.live_preview:
+        gp_preview.start(self.preview_budget)
+    else:
+        gp_preview.stop()
+
 ####################################
 ####    CLASSES
 #
@@ -273,6 +281,17 @@ class MenuPanel(bpy.types.Panel):
         layout.prop(scn, "texture_width")
         layout.prop(scn, "texture_height")
         row.operator("bake.bake_maps")
+        row = layout.row()
+        row.prop(scn, "projection_mode", expand=True)
+        row = layout.row(align=True)
+        row.prop(scn, "use_bake_cache")
+        row.prop(scn, "bake_cache_size")
+        row = layout.row(align=True)
+        row.prop(scn, "bake_cache_dir")
+        row.prop(scn, "bake_cache_disk_size")
+        row = layout.row(align=True)
+        row.prop(scn, "lod_levels")
+        row.operator("bake.bake_lods")
 
         if context.active_object.active_material:
             mat = context.active_object.active_material
@@ -284,9 +303,15 @@ class MenuPanel(bpy.types.Panel):
             except:
                 pass
 
+        row = layout.row(align=True)
+        row.prop(scn, "live_preview")
+        row.prop(scn, "preview_budget")
+
         col = layout.column()
         col.label(text="Output:")
         row = col.row()
+        row.prop(scn, "output_mode", expand=True)
+        row = col.row()
         row.operator("bake.bake_gptex")
 
 
@@ -324,17 +349,20 @@ class BakeMask(bpy.types.Operator):
         return context.active_object is not None
 
     def execute(self, context):
+        gp_profile.begin()
         tex_width = context.scene.texture_width
         tex_height = context.scene.texture_height
         if self.poll(context):
             ob = context.active_object
             handle_projection(context)
-            check_id(context, ob)
+            gp.check_id(context, ob)
             ##NEEDS CHANGING!: - Should use own draw method with class properties, and not scene properties.
             mask = get_mask(context, tex_width, tex_height, self.bake_type)
-            mask.pack(as_png=True)
+            gp_pack.defer(mask)
+            gp_memory.touch(mask)
             mat = get_mat(context, ob, mask, self.bake_type)
             ob.active_material = mat
+            gp_memory.enforce(context.scene)
             return {'FINISHED'}
         else:
             return {'CANCELLED'}
@@ -344,6 +372,46 @@ class BakeMask(bpy.types.Operator):
         layout.prop(self, "width")
         layout.prop(self, "height")
 
+class BakeLODs(bpy.types.Operator):
+    """Resamples an LOD chain of every mask of the active object from its master bake"""
+    bl_idname = "bake.bake_lods"
+    bl_label = "Make LODs"
+    bl_options = {'REGISTER', 'UNDO'}
+
+    @classmethod
+    def poll(cls, context):
+        return context.active_object is not None and context.active_object.get('ID') is not None
+
+    def execute(self, context):
+        gp_profile.begin()
+        scn = context.scene
+        ob = context.active_object
+        sizes = gp_resample.lod_sizes(scn.texture_width, scn.texture_height, scn.lod_levels)
+        made = 0
+        for map_type in [item[0] for item in BakeMask.supported_maps]:
+            master = get_master(ob, map_type)
+            if master is None:
+                continue
+            if master.get('fingerprint') != master_key(context, ob, map_type, master):
+                self.report({'WARNING'}, "The %s mask is out of date, calculate it again" % map_type)
+                continue
+            for level, (width, height) in enumerate(sizes):
+                if not gp_resample.can_resample(master, width, height):
+                    continue
+                tag = ''.join([map_type, '_LOD', str(level)])
+                lod = get_img(ob, ''.join([ob.name, '_', tag]), width, height, tag)
+                margin = gp_resample.scaled_margin(scn.render.bake.margin, master, width)
+                gp_resample.resample_image(master, lod, ob.data, margin)
+                gp_pack.defer(lod)
+                gp_memory.touch(lod)
+                made += 1
+        if not made:
+            self.report({'WARNING'}, "No masks to make LODs from")
+            return {'CANCELLED'}
+        self.report({'INFO'}, "Made %d LOD images" % made)
+        gp_memory.enforce(context.scene)
+        return {'FINISHED'}
+
 class BakeFinal(bpy.types.Operator):
     bl_idname = "bake.bake_gptex"
     bl_label = "Bake Texture"
@@ -353,15 +421,13 @@ class BakeFinal(bpy.types.Operator):
         tex_width = context.scene.texture_width
         tex_height = context.scene.texture_height
         ob = context.active_object
-        for img in bpy.data.images:
-            try:
-                if img['ID'] == ob['ID'] and img['type'] == 'GPTEX':
-                    return img
-            except:
-                continue
+        img = gp.find_item('IMG', ob.get('ID'), 'GPTEX')
+        if img is not None:
+            return img
         gptex = bpy.data.images.new(ob.name + "_GPTEX", tex_width, tex_height)
         gptex['ID'] = ob['ID']
         gptex['type'] = 'GPTEX'
+        gp.register_item('IMG', gptex)
         return gptex
     
     @classmethod
@@ -371,17 +437,41 @@ class BakeFinal(bpy.types.Operator):
             return mat.get('ID') is not None
 
     def execute(self, context):
+        gp_profile.begin()
         if self.poll(context):
             mat = context.active_object.active_material
+            if context.scene.output_mode == 'VERTEX':
+                return self.make_gpcol(context, mat)
             for node in mat.node_tree.nodes:
                 if node.name == "GPTEX":
                     gptex = node
             gptex.image = self.make_gptex(context)
-            mat.node_tree.nodes.active = gptex
-            enable_color_bake_settings()
-            bpy.ops.object.bake(type='DIFFUSE')
+            gp_memory.touch(gptex.image)
+            ramp, mask = get_ramp_mask(mat)
+            if ramp is not None:
+                #Fast path: the texture is just the mask through the ramp, no need to render it.
+                with gp_profile.span("Ramp LUT", context.active_object):
+                    gp_ramp.ramp_image(ramp.color_ramp, mask, gptex.image)
+            else:
+                mat.node_tree.nodes.active = gptex
+                enable_color_bake_settings()
+                with gp_profile.span("Cycles DIFFUSE", context.active_object):
+                    bpy.ops.object.bake(type='DIFFUSE')
+            gp_memory.enforce(context.scene)
+            return {'FINISHED'}
         else:
             self.report({'WARNING'}, "Wrong material or object")
+            return {'CANCELLED'}
+
+    def make_gpcol(self, context, mat):
+        """Writes the gradient per loop into the GPCOL vertex colors. No image, no bake"""
+        ob = context.active_object
+        ramp, mask = get_ramp_mask(mat)
+        if ramp is None:
+            self.report({'WARNING'}, "Vertex colors need a mask going straight into the ramp")
+            return {'CANCELLED'}
+        gp.write_vertex_colors(ob.data, "GPCOL", gp_ramp.ramp_loops(ramp.color_ramp, mask, ob.data))
+        return {'FINISHED'}
             
 
 def register():
@@ -404,16 +494,63 @@ def register():
         description="Height of the texture bake",
         default=512,
     )
+
+    gp_projection.register_props()
+    gp_cache.register_props()
+
+    bpy.types.Scene.lod_levels = IntProperty(
+        name="LODs: ",
+        description="Number of LOD images made from a mask, each half the size of the one before",
+        default=3,
+        min=1,
+    )
+
+    bpy.types.Scene.output_mode = EnumProperty(
+        name="Output",
+        description="Where Bake Texture writes the gradient",
+        default='TEXTURE',
+        items=[('TEXTURE', "Texture", "Bake into a GPTEX image"),
+               ('VERTEX', "Vertex Colors", "Write into the GPCOL vertex colors, no image needed")],
+    )
+
+    bpy.types.Scene.live_preview = BoolProperty(
+        name="Live Preview",
+        description="Show the gradient along the view direction in the 'GP_Preview' vertex colors, updated as the view turns",
+        default=False,
+        update=update_live_preview,
+    )
+
+    bpy.types.Scene.preview_budget = IntProperty(
+        name="ms",
+        description="Time the live preview may take per update, objects left over are updated on the next one",
+        default=gp_preview.DEFAULT_BUDGET,
+        min=1,
+        update=update_live_preview,
+    )
     bpy.utils.register_class(MenuPanel)
     bpy.utils.register_class(BakeMask)
+    bpy.utils.register_class(BakeLODs)
     bpy.utils.register_class(BakeFinal)
+    gp.register_handlers()
+    gp_pack.register_handlers()
     
 def unregister():
     del bpy.types.Scene.texture_width
     del bpy.types.Scene.texture_height
+    del bpy.types.Scene.lod_levels
+    gp_cache.unregister_props()
+    gp_projection.unregister_props()
+    del bpy.types.Scene.output_mode
+    del bpy.types.Scene.live_preview
+    del bpy.types.Scene.preview_budget
     bpy.utils.unregister_class(MenuPanel)
     bpy.utils.unregister_class(BakeMask)
+    bpy.utils.unregister_class(BakeLODs)
     bpy.utils.unregister_class(BakeFinal)
+    gp.unregister_handlers()
+    gp_pack.unregister_handlers()
+    gp_preview.stop()
+    gp_bakemat.clear()
     
 if __name__ == '__main__':
     register()